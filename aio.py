@@ -0,0 +1,394 @@
+import asyncio
+import collections
+import contextlib
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from jlr.query_builder import QueryBuilder
+from jlr import sql
+from jlr.sql import RowCursor
+
+
+###
+# asyncio flavor of the jlr.sql convenience layer, atop psycopg2's
+# asynchronous connection mode: each statement is sent without
+# blocking, then awaited by watching the connection's socket from the
+# event loop.
+#
+#   pool = AsyncConnectionPool(dsn)
+#
+#   async with pool.transaction() as con:
+#       docs = await query(con, 'select * from document where id = %s', (42,))
+#
+# psycopg2 async connections are always in autocommit mode, so each
+# statement is its own transaction unless wrapped in transaction().
+# Async connections don't do named (server-side) cursors or COPY, so
+# there's no query_iter() / query_columns() or bulk_insert(method='copy')
+# here.
+###
+
+
+async def connect(dsn, cursor_factory=RowCursor):
+    con = psycopg2.connect(dsn, cursor_factory=cursor_factory, async_=True)
+    await wait(con)
+
+    return con
+
+
+async def wait(con):
+    ###
+    # Drive con's current async operation to completion, yielding to
+    # the event loop whenever it needs to wait on the socket. Raises
+    # whatever psycopg2 error the operation produced.
+    ###
+    loop = asyncio.get_running_loop()
+
+    while True:
+        state = con.poll()
+
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        elif state == psycopg2.extensions.POLL_READ:
+            await _fd_ready(loop, loop.add_reader, loop.remove_reader,
+                            con.fileno())
+        elif state == psycopg2.extensions.POLL_WRITE:
+            await _fd_ready(loop, loop.add_writer, loop.remove_writer,
+                            con.fileno())
+        else:
+            raise psycopg2.OperationalError('Bad poll state: %r' % (state,))
+
+
+async def _fd_ready(loop, add, remove, fd):
+    ready = loop.create_future()
+
+    def wake():
+        if not ready.done():
+            ready.set_result(None)
+
+    add(fd, wake)
+    try:
+        await ready
+    finally:
+        remove(fd)
+
+
+async def _execute(con, stmt, params, row_mode=None):
+    cur = sql._cursor(con, row_mode)
+    cur.execute(stmt, params)
+    await wait(con)
+
+    return cur
+
+
+@contextlib.asynccontextmanager
+async def transaction(con, isolation_level=None):
+    ###
+    # BEGIN / COMMIT around the block, ROLLBACK if it raises.
+    # isolation_level as in 'SERIALIZABLE', else the server default.
+    ###
+    begin = 'BEGIN'
+    if isolation_level:
+        begin += ' ISOLATION LEVEL ' + isolation_level
+
+    await execute(con, begin)
+    try:
+        yield con
+    except BaseException:
+        if not con.closed and not con.isexecuting():
+            await execute(con, 'ROLLBACK')
+        raise
+    else:
+        await execute(con, 'COMMIT')
+
+
+async def query_single_column(con, stmt, params=None):
+    cur = await _execute(con, stmt, params, row_mode='tuple')
+    colvalues = [r[0] for r in cur.fetchall()]
+    cur.close()
+
+    return colvalues
+
+
+async def query_single_value(con, stmt, params=None):
+    cur = await _execute(con, stmt, params, row_mode='tuple')
+
+    assert cur.rowcount < 2
+    if cur.rowcount == 1:  # allow either 0 or 1 rows.
+        r = cur.fetchone()[0]
+    else:
+        r = None
+
+    cur.close()
+
+    return r
+
+
+async def query_single_row(con, stmt, params=None, row_mode=None):
+    cur = await _execute(con, stmt, params, row_mode=row_mode)
+
+    assert cur.rowcount < 2  # allow either 0 or 1 rows.
+    r = cur.fetchone()
+
+    cur.close()
+
+    return r
+
+query_single = query_single_row  # Alias.
+
+
+async def query(con, stmt, params=None, row_mode=None):
+    cur = await _execute(con, stmt, params, row_mode=row_mode)
+    rows = cur.fetchall()
+    cur.close()
+
+    return rows
+
+
+async def query_json_strings(con, stmt, params=None):
+    results = await query_single_column(con, stmt, params=params)
+    if results:
+        return '[' + ',\n '.join(results) + ']'
+
+    return '[]'  # smell like empty json array.
+
+
+async def query_as_json(con, stmt, params=None, strategy='rows'):
+    # See sql.query_as_json().
+    if strategy == 'auto':
+        plan = await query_single_value(con, 'explain (format json) ' + stmt,
+                                        params)
+        strategy = sql._json_strategy_for_plan(plan[0]['Plan'])
+
+    if strategy == 'agg':
+        return await query_single_value(con, sql._as_json_agg_statement(stmt),
+                                        params)
+    elif strategy != 'rows':
+        raise ValueError('Unknown query_as_json strategy %r' % (strategy,))
+
+    return await query_json_strings(con, sql._as_json_statement(stmt), params)
+
+
+async def execute(con, stmt, params=None):
+    cur = await _execute(con, stmt, params)
+    retval = cur.rowcount
+    cur.close()
+
+    return retval
+
+
+async def insert(con, tableName: str, rowDict: dict, excludeKeys=None,
+                 return_columns=None):
+    # See sql.insert().
+    statement = sql._insert_statement(tableName, rowDict, excludeKeys,
+                                      return_columns)
+
+    cur = await _execute(con, statement, rowDict)
+    try:
+        if return_columns:
+            return cur.fetchone()
+        return cur.rowcount
+    finally:
+        cur.close()
+
+
+async def bulk_insert(con, tableName: str, rowDictList: list,
+                      colList=None, excludeKeys=None,
+                      addToEveryRow=None, return_column=None,
+                      batch_size=None):
+    ###
+    # See sql.bulk_insert(); the "insert ... values (), ()" method only.
+    # If batch_size, insert batch_size rows per statement.
+    ###
+    if not rowDictList:
+        # Nothing to insert!
+        return None
+
+    if batch_size:
+        batches = [rowDictList[i:i + batch_size]
+                   for i in range(0, len(rowDictList), batch_size)]
+    else:
+        batches = [rowDictList]
+
+    return_results = []
+    rc = 0
+
+    for batch in batches:
+        statement, statement_data = sql._bulk_insert_statement(
+                    tableName, batch, colList, excludeKeys, addToEveryRow,
+                    return_column)
+
+        cur = await _execute(con, statement, statement_data, row_mode='tuple')
+        rc += cur.rowcount
+
+        if return_column:
+            return_results.extend(res[0] for res in cur.fetchall())
+
+        cur.close()
+
+    if return_column:
+        return return_results
+
+    return rc
+
+
+class QueryTool(QueryBuilder):
+    #
+    # Async sql.QueryTool: a QueryBuilder holding an async connection,
+    # whose query(), query_single_value(), etc. are coroutines.
+
+    def __init__(self, con, normalize_in_lists=False, row_mode=None):
+        QueryBuilder.__init__(self, normalize_in_lists=normalize_in_lists)
+        self._con = con
+        self._row_mode = row_mode
+
+    async def query_single_value(self):
+        return await query_single_value(self._con, self.statement,
+                                        self.parameters)
+
+    async def query_single_column(self):
+        return await query_single_column(self._con, self.statement,
+                                         self.parameters)
+
+    async def query_single_row(self):
+        return await query_single_row(self._con, self.statement,
+                                      self.parameters,
+                                      row_mode=self._row_mode)
+
+    query_single = query_single_row # Alias
+
+    async def query(self):
+        return await query(self._con, self.statement, self.parameters,
+                           row_mode=self._row_mode)
+
+    async def query_json_strings(self):
+        return await query_json_strings(self._con, self.statement,
+                                        self.parameters)
+
+    async def query_as_json(self, strategy='rows'):
+        return await query_as_json(self._con, self.statement,
+                                   self.parameters, strategy=strategy)
+
+
+class PoolExhaustedException(Exception):
+    pass
+
+
+class AsyncConnectionPool:
+    # asyncio counterpart of db.ConnectionPool: grows on demand up to
+    # max_size connections, after which acquire() waits (at most
+    # checkout_timeout_secs) for one to be released. Connections idle
+    # longer than idle_timeout_secs are closed upon the next release,
+    # down to min_size.
+    #
+    # Not thread-safe; use from the one event loop.
+
+    def __init__(self, dsn, min_size=1, max_size=10,
+                 checkout_timeout_secs=30, idle_timeout_secs=30,
+                 cursor_factory=RowCursor):
+        assert 0 <= min_size <= max_size and max_size > 0
+
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout_secs = checkout_timeout_secs
+        self.idle_timeout_secs = idle_timeout_secs
+        self.cursor_factory = cursor_factory
+
+        # (connection, last released time), most recent on the right.
+        self._idle = collections.deque()
+        self._size = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                        self._cond.wait_for(self._available),
+                        self.checkout_timeout_secs)
+            except asyncio.TimeoutError:
+                raise PoolExhaustedException(
+                        'Timed out after %s secs waiting on a'
+                        ' connection' % self.checkout_timeout_secs)
+
+            while self._idle:
+                con, _ = self._idle.pop()
+                if not con.closed:
+                    return con
+                # Closed out from under us (server restart, etc.)
+                self._size -= 1
+
+            # Reserve the slot, then connect outside of the lock.
+            self._size += 1
+
+        try:
+            return await connect(self.dsn, cursor_factory=self.cursor_factory)
+        except BaseException:
+            async with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    async def release(self, con, close=False):
+        # A connection still mid-statement (its awaiting task cancelled)
+        # or left inside a transaction is in no state to hand out again.
+        if not close and not con.closed:
+            close = con.isexecuting() or \
+                con.info.transaction_status != \
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+        async with self._cond:
+            if close or con.closed:
+                self._size -= 1
+                if not con.closed:
+                    if con.isexecuting():
+                        # Don't leave the server grinding away on it.
+                        con.cancel()
+                    con.close()
+            else:
+                self._idle.append((con, time.time()))
+                self._evict_idle()
+
+            self._cond.notify()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        con = await self.acquire()
+        try:
+            yield con
+        finally:
+            await self.release(con)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, isolation_level=None):
+        async with self.connection() as con:
+            async with transaction(con, isolation_level=isolation_level):
+                yield con
+
+    async def close(self):
+        async with self._cond:
+            while self._idle:
+                con, _ = self._idle.popleft()
+                self._size -= 1
+                con.close()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def _available(self):
+        return self._idle or self._size < self.max_size
+
+    def _evict_idle(self):
+        horizon = time.time() - self.idle_timeout_secs
+
+        while self._idle and self._size > self.min_size \
+                and self._idle[0][1] < horizon:
+            con, _ = self._idle.popleft()
+            self._size -= 1
+            con.close()
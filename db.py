@@ -1,22 +1,40 @@
+import os
+import re
+import json
+import logging
 import time
+import tempfile
 import threading
-from functools import wraps
+import collections
+import concurrent.futures
+import itertools
+from functools import wraps, partial
 
 import psycopg2
 import psycopg2.extras
 import psycopg2.extensions
 
-from flask import g
+from flask import g, request
+
+from jlr.sql import enable_prepared_statements, RowCursor, QueryTool
 
 # Default exports
-__all__ = ('configure_flask', 'configure_flask_socketio')
+__all__ = ('configure_flask', 'configure_flask_socketio', 'gather',
+           'read_only', 'read_query_tool')
+
+log = logging.getLogger(__name__)
 
 ###
 # Flask + psycopg helpers
 ###
 
 
-def configure_flask(flask_app, params, idle_timeout_secs=30, register_types=True):
+def configure_flask(flask_app, params, idle_timeout_secs=30, register_types=True,
+                    min_connections=1, max_connections=10,
+                    checkout_timeout_secs=30, prepared_statement_capacity=None,
+                    type_cache_path=None, replicas=None,
+                    replica_selection='round_robin', max_replica_lag_secs=None,
+                    read_only_endpoints=None):
     ###
     # Configure db access for a regular (non-socketio) flask app.
     # Set up DB-oriented before_first_request(), before_request(), and
@@ -26,19 +44,44 @@ def configure_flask(flask_app, params, idle_timeout_secs=30, register_types=True
     # flask request exceptions out (in production anyway, see notes
     # about bad interaction with flask debugger up in
     # ManagedConnection.begin_trasaction()).
+    #
+    # register_types='lazy' skips registering the psycopg_types up front,
+    # instead resolving custom types upon first sight. See LazyTypeCursor.
+    #
+    # Each request thread checks its own connection out of the pool,
+    # so concurrent requests under a threaded WSGI server no longer
+    # share (and stomp on) a single transaction.
+    #
+    # replicas, a list of read replica DSNs, has read-only requests' g.con
+    # come from a replica instead of params' primary (see ReplicaRouter
+    # for replica_selection and max_replica_lag_secs). A request is
+    # read-only if its view is decorated with @read_only, or if its
+    # endpoint is among read_only_endpoints (or, if that's a callable,
+    # read_only_endpoints(request) is true). Other requests can still
+    # send individual reads to a replica via read_query_tool().
     ###
 
     global mc
 
-    configure(params, timeout_secs=idle_timeout_secs)
+    configure(params, timeout_secs=idle_timeout_secs,
+              cursor_factory=_cursor_factory_for(register_types),
+              min_connections=min_connections,
+              max_connections=max_connections,
+              checkout_timeout_secs=checkout_timeout_secs,
+              prepared_statement_capacity=prepared_statement_capacity,
+              replicas=replicas, replica_selection=replica_selection,
+              max_replica_lag_secs=max_replica_lag_secs)
 
     flask_app.before_first_request(mc.start_closing_thread)
 
-    if register_types:
-        flask_app.before_first_request(register_composite_types)
+    if register_types and register_types != 'lazy':
+        flask_app.before_first_request(
+                partial(register_composite_types, cache_path=type_cache_path))
 
     def begin_and_assign_tx():
-        g.con = mc.begin_transaction()
+        g.con = mc.begin_transaction(
+                    read_only=_is_read_only_request(flask_app,
+                                                    read_only_endpoints))
 
     flask_app.before_request(begin_and_assign_tx)
 
@@ -57,10 +100,42 @@ def configure_flask(flask_app, params, idle_timeout_secs=30, register_types=True
 
 
 def configure_flask_socketio(params, register_types=True,
-                             idle_timeout_secs=30):
+                             idle_timeout_secs=30,
+                             min_connections=1, max_connections=10,
+                             checkout_timeout_secs=30,
+                             prepared_statement_capacity=None,
+                             type_cache_path=None, green=None,
+                             replicas=None, replica_selection='round_robin',
+                             max_replica_lag_secs=None):
+    ###
+    # green='gevent' or 'eventlet', for flask-socketio apps served by
+    # that async mode: psycopg2 then yields to the hub while awaiting
+    # the server (see make_green()), and each handler greenlet running
+    # under mc.with_transaction() checks out its own pooled connection.
+    # So a handler blocked in a query no longer stalls every other
+    # socket, and concurrent handlers don't share one transaction.
+    #
+    # Requires the app to have monkey patched (at least) threading,
+    # as flask-socketio already requires of those async modes, for the
+    # pool's waiting and the idle-closing thread to be green as well.
+    #
+    # With replicas, handlers decorated @read_only (beneath
+    # @mc.with_transaction) run on a replica; see configure_flask().
+    ###
     global mc
 
-    configure(params, timeout_secs=idle_timeout_secs)
+    if green:
+        make_green(green)
+
+    configure(params, timeout_secs=idle_timeout_secs,
+              cursor_factory=_cursor_factory_for(register_types),
+              min_connections=min_connections,
+              max_connections=max_connections,
+              checkout_timeout_secs=checkout_timeout_secs,
+              prepared_statement_capacity=prepared_statement_capacity,
+              green=green, replicas=replicas,
+              replica_selection=replica_selection,
+              max_replica_lag_secs=max_replica_lag_secs)
 
     # flask-socketio does not fire before_first_request(),
     # before_request(), or teardown_request(), so less can be
@@ -69,8 +144,8 @@ def configure_flask_socketio(params, register_types=True,
 
     mc.start_closing_thread()
 
-    if register_types:
-        register_composite_types()
+    if register_types and register_types != 'lazy':
+        register_composite_types(cache_path=type_cache_path)
 
     return mc
 
@@ -79,68 +154,517 @@ def configure_flask_socketio(params, register_types=True,
 # Internals from here on out
 ####
 
+def _green_wait_callback(green):
+    if green == 'gevent':
+        from gevent.socket import wait_read, wait_write
+    elif green == 'eventlet':
+        from eventlet.hubs import trampoline
+
+        def wait_read(fd):
+            trampoline(fd, read=True)
+
+        def wait_write(fd):
+            trampoline(fd, write=True)
+    else:
+        raise ValueError('Unknown green %r; expected gevent or eventlet'
+                         % (green,))
+
+    def wait_callback(con):
+        while True:
+            state = con.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            elif state == psycopg2.extensions.POLL_READ:
+                wait_read(con.fileno())
+            elif state == psycopg2.extensions.POLL_WRITE:
+                wait_write(con.fileno())
+            else:
+                raise psycopg2.OperationalError(
+                            'Bad poll state: %r' % (state,))
+
+    return wait_callback
+
+
+def _green_threading_patched(green):
+    if green == 'gevent':
+        import gevent.monkey
+        return gevent.monkey.is_module_patched('threading')
+    elif green == 'eventlet':
+        import eventlet.patcher
+        return eventlet.patcher.is_monkey_patched('thread')
+
+    raise ValueError('Unknown green %r; expected gevent or eventlet'
+                     % (green,))
+
+
+def _local_class(green):
+    # Per-thread, or per-greenlet, storage.
+    if green == 'gevent':
+        from gevent.local import local
+        return local
+    elif green == 'eventlet':
+        from eventlet.corolocal import local
+        return local
+
+    return threading.local
+
+
+class PoolExhaustedException(Exception):
+    pass
+
+
+class ConnectionPool():
+    # Thread-safe pool of psycopg2 connections.
+    #
+    # Grows on demand up to max_size connections. Once all are checked
+    # out, callers wait (at most checkout_timeout_secs, and at most
+    # max_waiting of them at a time) for one to be returned. Idle
+    # connections beyond min_size are closed by evict_idle() once
+    # they've sat unused for idle_timeout_secs.
+    def __init__(self, params, cursor_factory, min_size=1, max_size=10,
+                 checkout_timeout_secs=30, idle_timeout_secs=30,
+                 max_waiting=None, prepared_statement_capacity=None,
+                 read_only=False):
+        assert 0 <= min_size <= max_size and max_size > 0
+
+        self.params = params
+        self.cursor_factory = cursor_factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout_secs = checkout_timeout_secs
+        self.idle_timeout_secs = idle_timeout_secs
+        self.prepared_statement_capacity = prepared_statement_capacity
+        self.read_only = read_only
+
+        if max_waiting is None:
+            max_waiting = max_size * 4
+        self.max_waiting = max_waiting
+
+        # (connection, last returned time) pairs. Most recently returned
+        # on the right, so checkouts favor warm connections and the
+        # stalest ones gather on the left for eviction.
+        self._idle = collections.deque()
+        # Count of connections open, idle or checked out.
+        self._size = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+
+    def getconn(self, timeout_secs=None):
+        if timeout_secs is None:
+            timeout_secs = self.checkout_timeout_secs
+        deadline = time.time() + timeout_secs
+
+        with self._cond:
+            while True:
+                while self._idle:
+                    con, _ = self._idle.pop()
+                    if not con.closed:
+                        return con
+                    # Closed out from under us (server restart, etc.)
+                    self._size -= 1
+
+                if self._size < self.max_size:
+                    # Reserve the slot, then connect outside of the lock.
+                    self._size += 1
+                    break
+
+                if self._waiting >= self.max_waiting:
+                    raise PoolExhaustedException(
+                            'Too many threads (%d) already waiting on a'
+                            ' connection' % self._waiting)
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhaustedException(
+                            'Timed out after %s secs waiting on a'
+                            ' connection' % timeout_secs)
+
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, con, close=False):
+        with self._cond:
+            if close or con.closed:
+                self._size -= 1
+                if not con.closed:
+                    con.close()
+            else:
+                self._idle.append((con, time.time()))
+
+            self._cond.notify()
+
+    def evict_idle(self):
+        # Close connections idle longer than idle_timeout_secs, but
+        # never drop below min_size open connections.
+        horizon = time.time() - self.idle_timeout_secs
+
+        with self._cond:
+            while self._idle and self._size > self.min_size \
+                    and self._idle[0][1] < horizon:
+                con, _ = self._idle.popleft()
+                self._size -= 1
+                con.close()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                con, _ = self._idle.popleft()
+                self._size -= 1
+                con.close()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def _connect(self):
+        con = psycopg2.connect(self.params,
+                               cursor_factory=self.cursor_factory)
+
+        if self.read_only:
+            # Transactions begin as BEGIN READ ONLY, no extra round trip.
+            con.set_session(readonly=True)
+
+        if self.prepared_statement_capacity:
+            # Fresh connection, fresh (empty) prepared statement cache.
+            enable_prepared_statements(
+                    con, capacity=self.prepared_statement_capacity)
+
+        return con
+
+
+class ReplicaRouter():
+    # Picks a read replica connection for read-only transactions.
+    #
+    # One ConnectionPool per replica DSN, each sized as the primary's.
+    # Replicas are tried in turn, per selection:
+    #
+    #   'round_robin': rotate which replica is tried first.
+    #   'least_busy': fewest connections currently checked out first.
+    #
+    # A replica which fails to connect is skipped for down_retry_secs.
+    # One whose pool is exhausted is skipped without waiting.
+    #
+    # If max_lag_secs, a replica is also skipped while replaying more
+    # than that far behind its primary, as checked at most every
+    # lag_check_interval_secs. (Measured as the age of the last replayed
+    # transaction, so a replica of an idle primary looks to lag too.)
+    #
+    # getconn() returns (None, None) if no replica is usable, for the
+    # caller to fall back to the primary.
+
+    def __init__(self, replicas, cursor_factory, selection='round_robin',
+                 max_lag_secs=None, lag_check_interval_secs=5,
+                 down_retry_secs=30, **pool_kwargs):
+        if selection not in ('round_robin', 'least_busy'):
+            raise ValueError('Unknown replica selection %r' % (selection,))
+
+        self.pools = [ConnectionPool(dsn, cursor_factory, read_only=True,
+                                     **pool_kwargs)
+                      for dsn in replicas]
+        self.selection = selection
+        self.max_lag_secs = max_lag_secs
+        self.lag_check_interval_secs = lag_check_interval_secs
+        self.down_retry_secs = down_retry_secs
+
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        # Replica pool -> time until which to skip it.
+        self._skip_until = {}
+        # Replica pool -> time its lag was last found acceptable.
+        self._lag_ok_at = {}
+
+    def getconn(self):
+        for pool in self._candidates():
+            try:
+                con = pool.getconn(timeout_secs=0)
+            except PoolExhaustedException:
+                continue
+            except psycopg2.OperationalError:
+                self._skip(pool, self.down_retry_secs)
+                continue
+
+            if self.max_lag_secs is not None and not self._lag_ok(pool, con):
+                continue
+
+            return pool, con
+
+        return None, None
+
+    def evict_idle(self):
+        for pool in self.pools:
+            pool.evict_idle()
+
+    def closeall(self):
+        for pool in self.pools:
+            pool.closeall()
+
+    def _candidates(self):
+        now = time.time()
+        pools = [p for p in self.pools if self._skip_until.get(p, 0) <= now]
+
+        if self.selection == 'least_busy':
+            pools.sort(key=lambda p: p.size - p.idle_count)
+        elif pools:
+            first = next(self._turn) % len(pools)
+            pools = pools[first:] + pools[:first]
+
+        return pools
+
+    def _lag_ok(self, pool, con):
+        # Is the replica con came from keeping up? Returns con to pool
+        # if not.
+        if self._lag_ok_at.get(pool, 0) > \
+                time.time() - self.lag_check_interval_secs:
+            return True
+
+        try:
+            cur = con.cursor()
+            cur.execute(_REPLICA_LAG_SQL)
+            lag = cur.fetchone()[0]
+            cur.close()
+            # Don't leave the transaction's snapshot as of the check.
+            con.rollback()
+        except psycopg2.Error:
+            pool.putconn(con, close=True)
+            self._skip(pool, self.down_retry_secs)
+            return False
+
+        if lag > self.max_lag_secs:
+            pool.putconn(con)
+            self._skip(pool, self.lag_check_interval_secs)
+            return False
+
+        self._lag_ok_at[pool] = time.time()
+        return True
+
+    def _skip(self, pool, secs):
+        with self._lock:
+            self._skip_until[pool] = time.time() + secs
+
+
+# Seconds behind the primary, or 0 when not a standby at all (such as
+# a plain database standing in for a replica in tests).
+_REPLICA_LAG_SQL = \
+    "select case when pg_is_in_recovery()" \
+    " then coalesce(extract(epoch from" \
+    " now() - pg_last_xact_replay_timestamp()), 0)::float8" \
+    " else 0 end"
+
+
+def _is_read_only_request(flask_app, read_only_endpoints):
+    view = flask_app.view_functions.get(request.endpoint)
+    if getattr(view, '_jlr_read_only', False):
+        return True
+
+    if read_only_endpoints is None:
+        return False
+
+    if callable(read_only_endpoints):
+        return bool(read_only_endpoints(request))
+
+    return request.endpoint in read_only_endpoints
+
+
 class ManagedConnection():
-    # Singleton class managing db connection, transaction state,
-    # and auto-closing the db connection after 30sec inactivity.
-    def __init__(self, params, cursor_factory, timeout_secs=30):
+    # Singleton class managing a pool of db connections, per-thread
+    # transaction state, and auto-closing pooled connections after 30sec
+    # inactivity.
+    def __init__(self, params, cursor_factory, timeout_secs=30,
+                 min_connections=1, max_connections=10,
+                 checkout_timeout_secs=30, prepared_statement_capacity=None,
+                 green=None, replicas=None, replica_selection='round_robin',
+                 max_replica_lag_secs=None):
         self.params = params
         self.cursor_factory = cursor_factory
         self.timeout_secs = timeout_secs
-        self.con = None
-        self.busy = False
-        self.last_used = None
-        self.commit_after_complete = True
+        self.pool = ConnectionPool(params, cursor_factory,
+                                   min_size=min_connections,
+                                   max_size=max_connections,
+                                   checkout_timeout_secs=checkout_timeout_secs,
+                                   idle_timeout_secs=timeout_secs,
+                                   prepared_statement_capacity=prepared_statement_capacity)
+
+        # Read-only transactions' connections come from here, if given
+        # any replicas.
+        self.replicas = None
+        if replicas:
+            self.replicas = ReplicaRouter(
+                        replicas, cursor_factory, selection=replica_selection,
+                        max_lag_secs=max_replica_lag_secs,
+                        min_size=min_connections, max_size=max_connections,
+                        checkout_timeout_secs=checkout_timeout_secs,
+                        idle_timeout_secs=timeout_secs,
+                        prepared_statement_capacity=prepared_statement_capacity)
+
+        # Per-thread (per-greenlet, if green) checked-out connection,
+        # the pool it came from, and rollback-only flag. Plus any
+        # separate read connection, see read_connection().
+        self._local = _local_class(green)()
+
+        # Worker threads for gather(), started upon first use.
+        self._gather_executor = None
+        self._gather_lock = threading.Lock()
+
+    @property
+    def con(self):
+        # The connection checked out by the current thread, if any.
+        return getattr(self._local, 'con', None)
+
+    @property
+    def busy(self):
+        return self.con is not None
 
     def start_closing_thread(self):
         def close_when_idle():
             while True:
                 time.sleep(self.timeout_secs)
-                if not self.busy \
-                        and self.con \
-                        and time.time() > self.last_used + self.timeout_secs:
-
-                    self.close()
+                self.pool.evict_idle()
+                if self.replicas:
+                    self.replicas.evict_idle()
 
         threading.Thread(target=close_when_idle).start()
 
     def close(self):
-        if self.con:
-            self.con.close()
-            self.con = None
+        con = self.con
+        if con:
+            self._local.con = None
+            self._source_pool().putconn(con, close=True)
+
+        self._release_read_connection()
+
+        if self.replicas:
+            self.replicas.closeall()
 
-        self.busy = False
+        if self._gather_executor:
+            self._gather_executor.shutdown(wait=False)
+            self._gather_executor = None
 
-    def begin_transaction(self):
-        if not self.con:
-            self.con = self.__connection()
+        self.pool.closeall()
 
-        if self.busy:
+    def begin_transaction(self, read_only=False):
+        ###
+        # Check out the current thread's connection, beginning its
+        # transaction. If read_only and given replicas, from a replica,
+        # falling back to the primary if none is usable.
+        ###
+        con = self.con
+
+        if con:
             # Wacky! Holdover from bad interaction with flask debugger
             # in devel mode and hitting a caught exception (in debugger)
             # on the prior request. Grr. The flask debugger is deeper in
             # flask wsgi server than our "with_transaction()" decorator,
             # so it doesn't have a chance to rollback itself.
-            self.con.rollback()
+            con.rollback()
+        else:
+            pool = con = None
+            if read_only and self.replicas:
+                pool, con = self.replicas.getconn()
+
+            if con is None:
+                pool, con = self.pool, self.pool.getconn()
+
+            self._local.con = con
+            self._local.pool = pool
+
+        self._local.commit_after_complete = True
+
+        return con
+
+    def read_connection(self):
+        ###
+        # A connection for reads within the current thread's
+        # transaction: the transaction's own if it is on a replica (or
+        # there are no replicas), otherwise one checked out from a
+        # replica for the rest of the transaction, as for a heavy
+        # report query in an otherwise read-write request. Its reads
+        # don't see this transaction's uncommitted writes, of course.
+        #
+        # Only within begin_transaction() / complete_transaction(),
+        # which returns any replica connection to its pool.
+        ###
+        con = self.con
+        if con is None:
+            raise RuntimeError('read_connection() outside of a transaction')
+
+        if not self.replicas or self._source_pool() is not self.pool:
+            return con
 
-        self.busy = True
-        self.last_used = time.time()
+        read_con = getattr(self._local, 'read_con', None)
+        if read_con is None:
+            pool, read_con = self.replicas.getconn()
+            if read_con is None:
+                # No usable replica; read on the primary after all.
+                return con
 
-        return self.con
+            self._local.read_con = read_con
+            self._local.read_pool = pool
+
+        return read_con
 
     def set_rollback_only(self):
         # Indicate that the only way this TX should end is
         # via rollback, not commit. Observed by complete_transaction()
-        self.commit_after_complete = False
+        self._local.commit_after_complete = False
 
     def complete_transaction(self):
-        if self.con:
-            if self.commit_after_complete:
-                self.con.commit()
+        con = self.con
+        if not con:
+            return
+
+        pool = self._source_pool()
+        self._local.con = self._local.pool = None
+        discard = False
+
+        self._release_read_connection()
+
+        try:
+            if getattr(self._local, 'commit_after_complete', True):
+                con.commit()
             else:
-                self.con.rollback()
-                self.commit_after_complete = True  # clear it for next request.
+                con.rollback()
+        except psycopg2.Error:
+            # Don't hand a connection in unknown state to the next thread.
+            discard = True
+            raise
+        finally:
+            self._local.commit_after_complete = True  # clear it for next request.
+            pool.putconn(con, close=discard)
+
+    def _source_pool(self):
+        # The pool the current thread's connection came from.
+        return getattr(self._local, 'pool', None) or self.pool
+
+    def _release_read_connection(self):
+        read_con = getattr(self._local, 'read_con', None)
+        if read_con is None:
+            return
+
+        pool = self._local.read_pool
+        self._local.read_con = self._local.read_pool = None
 
-        self.busy = False
+        discard = False
+        try:
+            read_con.rollback()
+        except psycopg2.Error:
+            discard = True
+        finally:
+            pool.putconn(read_con, close=discard)
 
     def with_transaction(self, func,):
         """
@@ -150,9 +674,11 @@ class ManagedConnection():
             within a flask_socketio app. Grr.
         """
 
+        read_only = getattr(func, '_jlr_read_only', False)
+
         @wraps(func)
         def doit(*args):
-            con = self.begin_transaction()
+            con = self.begin_transaction(read_only=read_only)
             try:
                 func(con, *args)
             except Exception as e:
@@ -163,21 +689,130 @@ class ManagedConnection():
 
         return doit
 
-    def __connection(self):
-        return psycopg2.connect(self.params,
-                                cursor_factory=self.cursor_factory)
+    def gather(self, *query_tools, snapshot=False):
+        ###
+        # Run independent, read-only queries concurrently, each on its
+        # own pooled connection, returning their results in order. So
+        # a page built from a dozen QueryTools waits on the slowest,
+        # not the sum of them.
+        #
+        # Each of query_tools is either a QueryTool, run via .query(),
+        # or a (QueryTool, method name) pair, as in
+        # (counts_tool, 'query_single_value'). Methods must return
+        # their results eagerly, so not iter() and friends.
+        #
+        # Each runs in its own READ ONLY transaction, rolled back after.
+        # Such separate transactions may each see different commits.
+        # If snapshot, they instead all import one snapshot exported
+        # (via pg_export_snapshot()) from yet another pooled connection,
+        # so see the database as of one single moment. Either way, none
+        # see uncommitted changes made on the calling thread's
+        # connection.
+        #
+        # Needs up to len(query_tools) (+1 if snapshot) connections
+        # beyond the caller's, so mind max_connections; a starved
+        # checkout raises PoolExhaustedException, as usual.
+        ###
+        calls = []
+        for item in query_tools:
+            tool, method = item if isinstance(item, tuple) else (item, 'query')
+            calls.append((tool, method))
+
+        exporter = snapshot_id = None
+        if snapshot:
+            exporter = self.pool.getconn()
+            try:
+                cur = exporter.cursor()
+                cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ,'
+                            ' READ ONLY')
+                cur.execute('SELECT pg_export_snapshot()')
+                snapshot_id = cur.fetchone()[0]
+                cur.close()
+            except Exception:
+                self._release_gather_connection(exporter)
+                raise
+
+        try:
+            executor = self._executor_for_gather()
+            futures = [executor.submit(self._gather_one, tool, method,
+                                       snapshot_id)
+                       for tool, method in calls]
+
+            # Wait for all, lest an early failure return the exporter
+            # while the others are yet to import its snapshot.
+            concurrent.futures.wait(futures)
+
+            return [f.result() for f in futures]
+        finally:
+            if exporter:
+                self._release_gather_connection(exporter)
+
+    def _gather_one(self, tool, method, snapshot_id):
+        con = self.pool.getconn()
+        try:
+            cur = con.cursor()
+            if snapshot_id:
+                cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ,'
+                            ' READ ONLY')
+                cur.execute('SET TRANSACTION SNAPSHOT %s', (snapshot_id,))
+            else:
+                cur.execute('SET TRANSACTION READ ONLY')
+            cur.close()
+
+            # Same query, other connection.
+            worker = tool.fork()
+            worker._con = con
+
+            return getattr(worker, method)()
+        finally:
+            self._release_gather_connection(con)
+
+    def _release_gather_connection(self, con):
+        discard = False
+        try:
+            con.rollback()
+        except psycopg2.Error:
+            # Don't hand a connection in unknown state to the next thread.
+            discard = True
+        finally:
+            self.pool.putconn(con, close=discard)
+
+    def _executor_for_gather(self):
+        with self._gather_lock:
+            if self._gather_executor is None:
+                self._gather_executor = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=self.pool.max_size,
+                            thread_name_prefix='jlr-gather')
+
+            return self._gather_executor
 
 # The singleton instance.
 mc = None
 
 
 def configure(params, timeout_secs=30,
-              cursor_factory=psycopg2.extras.NamedTupleCursor,
-              connect=False):
+              cursor_factory=RowCursor,
+              connect=False, min_connections=1, max_connections=10,
+              checkout_timeout_secs=30, prepared_statement_capacity=None,
+              green=None, replicas=None, replica_selection='round_robin',
+              max_replica_lag_secs=None):
     global mc
 
+    if mc:
+        # Reconfiguring; don't leak the prior pool's idle connections.
+        mc.pool.closeall()
+        if mc.replicas:
+            mc.replicas.closeall()
+
     mc = ManagedConnection(params, timeout_secs=timeout_secs,
-                           cursor_factory=cursor_factory)
+                           cursor_factory=cursor_factory,
+                           min_connections=min_connections,
+                           max_connections=max_connections,
+                           checkout_timeout_secs=checkout_timeout_secs,
+                           prepared_statement_capacity=prepared_statement_capacity,
+                           green=green, replicas=replicas,
+                           replica_selection=replica_selection,
+                           max_replica_lag_secs=max_replica_lag_secs)
 
     if connect:
         return mc.begin_transaction()
@@ -185,6 +820,44 @@ def configure(params, timeout_secs=30,
 def connection():
     return mc.begin_transaction()
 
+def read_only(func):
+    ###
+    # Mark a flask view (or a function wrapped by mc.with_transaction())
+    # as only reading, so its transaction may run on a read replica.
+    # Apply beneath @app.route().
+    ###
+    func._jlr_read_only = True
+    return func
+
+def read_query_tool(**kwargs):
+    # sql.QueryTool on the current thread's read connection; see
+    # ManagedConnection.read_connection().
+    return QueryTool(mc.read_connection(), **kwargs)
+
+def make_green(green):
+    ###
+    # Install a psycopg2 wait callback cooperating with the gevent or
+    # eventlet hub, so that a greenlet awaiting the server lets the
+    # others run. Process-wide, affecting all connections opened after.
+    #
+    # psycopg2 refuses COPY on connections under a wait callback, so
+    # sql.copy_insert() and sql.bulk_insert(method='copy') are out; use
+    # method 'insert' or 'unnest'. The helpers which COPY only as an
+    # optimization avoid it instead: sql.bulk_upsert() skips its COPY
+    # staging table, and sql.query_by_keys() / delete_by_keys() use
+    # strategy 'chunks' in place of 'temp_table'.
+    ###
+    if not _green_threading_patched(green):
+        raise RuntimeError('%s has not monkey patched threading;'
+                           ' patch before configuring green db access'
+                           % green)
+
+    psycopg2.extensions.set_wait_callback(_green_wait_callback(green))
+
+def gather(*query_tools, snapshot=False):
+    # See ManagedConnection.gather().
+    return mc.gather(*query_tools, snapshot=snapshot)
+
 
 def flask_connection():
     global mc
@@ -195,7 +868,8 @@ def flask_connection():
     return g._con
 
 
-def register_composite_types():
+def register_composite_types(cache_path=None, verify=True,
+                             max_age_secs=24 * 3600):
     ###
     # Teach psycopg about any custom type oids hinted at in custom
     # recipe table 'psycopg_types', if needed in this project.
@@ -204,17 +878,159 @@ def register_composite_types():
     # support, queries containing either of which will be returning
     # novel / surprising oids. So here we hint psycopg2 how to deal
     # with them.
+    #
+    # Resolving the types costs a catalog query plus another per
+    # composite type. Given cache_path, the resolved layouts are saved
+    # there (keyed by database), so the next process to start can skip
+    # all that. If verify, the saved layouts are first checked against
+    # a fingerprint of the relevant catalog rows (a single cheap query),
+    # otherwise trusted for up to max_age_secs. Either way, stale
+    # layouts are re-resolved and re-saved.
     ###
     con = mc.begin_transaction()
 
-    typeconverters = [o for o in psycopg2.__dict__.values() if
-                      isinstance(o, type(psycopg2.STRING))]
+    try:
+        layouts = None
+        fingerprint = None
 
-    oid_to_typeconverter = {}
-    for tc in typeconverters:
-        for oid in tc.values:
-            oid_to_typeconverter[oid] = tc
+        if cache_path:
+            cached = _read_type_cache(cache_path, con)
+
+            if cached and verify:
+                fingerprint = _types_fingerprint(con)
+                if cached['fingerprint'] == fingerprint:
+                    layouts = cached['types']
+
+            elif cached and time.time() < cached['written_at'] + max_age_secs:
+                layouts = cached['types']
+
+        if layouts is None:
+            layouts = _resolve_type_layouts(con)
+
+            if cache_path:
+                if fingerprint is None:
+                    fingerprint = _types_fingerprint(con)
+                _write_type_cache(cache_path, con, layouts, fingerprint)
+
+        _register_type_layouts(layouts)
+
+    finally:
+        mc.complete_transaction()
+
+
+class FastCompositeCaster(psycopg2.extras.CompositeCaster):
+    # Drop-in CompositeCaster, quicker on composite-heavy results:
+    #
+    #   * tokenize() splits on commas outright when the value has no
+    #     quoting (the common case: no value holding spaces, commas,
+    #     quotes, parens, backslashes, or empty strings), else makes one
+    #     regex-assisted pass.
+    #   * Each attribute's typecaster is looked up once, instead of per
+    #     value via cursor.cast(), and text attributes skip casting.
+    #   * Rows are the same per-type namedtuple class (__slots__ = ())
+    #     as ever, but built straight via tuple.__new__.
+    #
+    # Arrays of the composite go through psycopg2's C array parser,
+    # which calls parse() per element, so benefit likewise.
+
+    # Types psycopg2 would hand back as the very same str.
+    _UNCAST_OIDS = frozenset((19, 25, 705, 1043))  # name, text, unknown, varchar
+
+    _re_quoted = re.compile(r'"((?:[^"\\]|""|\\.)*)"', re.S)
+    _re_unescape = re.compile(r'["\\](.)', re.S)
+
+    def _create_type(self, name, attnames):
+        psycopg2.extras.CompositeCaster._create_type(self, name, attnames)
+
+        # Per-attribute typecasters, resolved upon first parse().
+        self._casters = None
 
+    def parse(self, s, curs):
+        if s is None:
+            return None
+
+        tokens = self.tokenize(s)
+        if len(tokens) != len(self.atttypes):
+            raise psycopg2.DataError(
+                "expecting %d components for the type %s, %d found instead" %
+                (len(self.atttypes), self.name, len(tokens)))
+
+        casters = self._casters
+        if casters is None:
+            casters = self._casters = self._resolve_casters(curs)
+
+        values = [token if caster is None or token is None
+                  else caster(token, curs)
+                  for caster, token in zip(casters, tokens)]
+
+        return self.make(values)
+
+    def make(self, values):
+        return tuple.__new__(self.type, values)
+
+    @classmethod
+    def tokenize(cls, s):
+        inner = s[1:-1]
+
+        if '"' not in inner:
+            # Unquoted values hold no commas or escapes, and an empty
+            # one is a NULL (empty strings are spelled "").
+            return [token or None for token in inner.split(',')]
+
+        tokens = []
+        pos = 0
+        end = len(inner)
+
+        while True:
+            if inner.startswith('"', pos):
+                m = cls._re_quoted.match(inner, pos)
+                if m is None:
+                    raise psycopg2.InterfaceError("can't parse type: %r" % (s,))
+
+                token = m.group(1)
+                if '"' in token or '\\' in token:
+                    token = cls._re_unescape.sub(r'\1', token)
+                pos = m.end()
+            else:
+                comma = inner.find(',', pos)
+                if comma == -1:
+                    comma = end
+                token = inner[pos:comma] or None
+                pos = comma
+
+            tokens.append(token)
+
+            if pos >= end:
+                return tokens
+
+            # Step past the comma; a trailing one means a trailing NULL.
+            pos += 1
+
+    def _resolve_casters(self, curs):
+        # Connection-level registrations win over global ones, so
+        # leave any such attributes to cursor.cast() to figure out.
+        connection_types = curs.connection.string_types if curs else {}
+
+        casters = []
+        for oid in self.atttypes:
+            if oid in self._UNCAST_OIDS and oid not in connection_types:
+                casters.append(None)
+            elif oid in psycopg2.extensions.string_types \
+                    and oid not in connection_types:
+                casters.append(psycopg2.extensions.string_types[oid])
+            else:
+                casters.append(partial(_cast_via_cursor, oid))
+
+        return casters
+
+
+def _cast_via_cursor(oid, token, curs):
+    return curs.cast(oid, token)
+
+
+def _resolve_type_layouts(con):
+    # JSON-friendly descriptions of the types to register, per the
+    # catalog. register_composite() does the composite legwork.
     cur = con.cursor()
     cur.execute('''
             select
@@ -231,27 +1047,295 @@ def register_composite_types():
             on pt.type_to_register = pgt.oid;
         ''')
 
+    layouts = []
+
     for c in cur.fetchall():
         if c.typcategory == 'C':
             # Composite type
-            psycopg2.extras.register_composite(c.type_to_register,
-                                               con, globally=True)
+            caster = psycopg2.extras.CompositeCaster._from_db(
+                                        c.type_to_register, con)
+            layouts.append({'kind': 'composite',
+                            'name': caster.name,
+                            'schema': caster.schema,
+                            'oid': caster.oid,
+                            'array_oid': caster.array_oid,
+                            'attrs': list(zip(caster.attnames,
+                                              caster.atttypes))})
         else:
             assert c.typcategory == 'S', \
                     'Do not understand type category %s' % c.typcategory
 
-            base_type_adaptor = oid_to_typeconverter.get(c.typbasetype)
+            layouts.append({'kind': 'domain_array',
+                            'name': c.type_to_register,
+                            'base_name': c.typname,
+                            'array_oid': c.typarray,
+                            'base_oid': c.typbasetype})
+
+    cur.close()
+
+    return layouts
+
+
+def _register_type_layouts(layouts):
+    typeconverters = [o for o in psycopg2.__dict__.values() if
+                      isinstance(o, type(psycopg2.STRING))]
+
+    oid_to_typeconverter = {}
+    for tc in typeconverters:
+        for oid in tc.values:
+            oid_to_typeconverter[oid] = tc
+
+    for layout in layouts:
+        if layout['kind'] == 'composite':
+            # Same as register_composite(globally=True), sans catalog.
+            caster = FastCompositeCaster(
+                            layout['name'], layout['oid'],
+                            [tuple(a) for a in layout['attrs']],
+                            array_oid=layout['array_oid'],
+                            schema=layout['schema'])
+
+            psycopg2.extensions.register_type(caster.typecaster)
+            if caster.array_typecaster is not None:
+                psycopg2.extensions.register_type(caster.array_typecaster)
+
+        else:
+            base_type_adaptor = oid_to_typeconverter.get(layout['base_oid'])
 
             if not base_type_adaptor:
                 raise Exception('Unknown type adaptor for %s'
                                 ' for domain array type %s'
-                                % (c.typname, c.type_to_register))
+                                % (layout['base_name'], layout['name']))
 
             psycopg2.extensions.register_type(
                 psycopg2.extensions.new_array_type(
-                    (c.typarray,), c.type_to_register + '[]',
+                    (layout['array_oid'],), layout['name'] + '[]',
                     base_type_adaptor))
 
+
+def _types_fingerprint(con):
+    # Changes whenever any of the psycopg_types rows, or the catalog
+    # rows describing those types (and composite's attributes), do.
+    cur = con.cursor()
+    cur.execute('''
+            select md5(coalesce(string_agg(
+                        pgt.oid::text || ':' || pgt.xmin::text || ':'
+                            || coalesce((select string_agg(a.attname || a.atttypid::text
+                                                            || a.xmin::text, ','
+                                                           order by a.attnum)
+                                         from pg_catalog.pg_attribute a
+                                         where a.attrelid = pgt.typrelid
+                                            and pgt.typrelid <> 0), ''),
+                        ';' order by pgt.oid), ''))
+            from psycopg_types pt
+                join pg_catalog.pg_type pgt on pt.type_to_register = pgt.oid
+        ''')
+    fingerprint = cur.fetchone()[0]
     cur.close()
 
-    mc.complete_transaction()
+    return fingerprint
+
+
+def _type_cache_key(con):
+    info = con.info
+    return '%s:%s/%s' % (info.host, info.port, info.dbname)
+
+
+def _read_type_cache(cache_path, con):
+    try:
+        with open(cache_path) as f:
+            return json.load(f).get(_type_cache_key(con))
+    except (OSError, ValueError):
+        # Missing or mangled; just resolve afresh.
+        return None
+
+
+def _write_type_cache(cache_path, con, layouts, fingerprint):
+    try:
+        with open(cache_path) as f:
+            contents = json.load(f)
+    except (OSError, ValueError):
+        contents = {}
+
+    contents[_type_cache_key(con)] = {'written_at': time.time(),
+                                      'fingerprint': fingerprint,
+                                      'types': layouts}
+
+    # Write then rename, so concurrently starting workers never
+    # see a partial file. The cache is only a startup optimization, so
+    # an unwritable cache_path is logged rather than raised.
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+                            dir=os.path.dirname(os.path.abspath(cache_path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(contents, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.warning('Could not write type cache %s: %s', cache_path, e)
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+###
+# Lazy, on-demand custom type registration, as alternative to
+# register_composite_types() at startup.
+###
+
+class LazyTypeRegistry():
+    # Resolves + globally registers typecasters for composite, array of
+    # composite, and array of domain type oids as they're first seen in
+    # a result, once per process. hook, if set, is called as
+    # hook(oid, type_name, elapsed_secs) after each first-sight
+    # resolution, to measure what lazy registration costs.
+
+    def __init__(self, hook=None):
+        self.hook = hook
+
+        # oid -> typecaster, or None if nothing needed registering.
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+        # Bumped by each resolve(), once its typecasters are registered;
+        # oid -> the version which registered it. LazyTypeCursor notes
+        # the version as of execute(), rather than snapshotting psycopg2's
+        # whole typecaster table each time.
+        self.version = 0
+        self._versions = {}
+
+    def late_casts(self, cursor):
+        # [(column index, typecaster)] for the columns of LazyTypeCursor's
+        # current result whose type psycopg2 had no typecaster for at
+        # execute() time, so which arrive as strings.
+        late = []
+
+        for i, column in enumerate(cursor.description or ()):
+            oid = column.type_code
+            if oid in self._resolved:
+                caster = self._resolved[oid]
+                # Resolved since this cursor's execute()?
+                if caster is not None \
+                        and self._versions[oid] > cursor._jlr_types_version:
+                    late.append((i, caster))
+            elif oid not in psycopg2.extensions.string_types:
+                caster = self.resolve(cursor.connection, oid)
+                if caster is not None:
+                    late.append((i, caster))
+
+        return late
+
+    def resolve(self, con, oid):
+        with self._lock:
+            if oid in self._resolved:
+                return self._resolved[oid]
+
+            start = time.time()
+            caster, type_name = self._resolve(con, oid)
+            self._versions[oid] = self.version + 1
+            self._resolved[oid] = caster
+            self.version += 1
+
+        if self.hook:
+            self.hook(oid, type_name, time.time() - start)
+
+        return caster
+
+    def _resolve(self, con, oid):
+        cur = con.cursor()
+        cur.execute("""
+                select
+                    format_type(t.oid, null) as type_name,
+                    t.typtype,
+                    e.typtype as elem_typtype,
+                    e.typbasetype as elem_basetype,
+                    format_type(e.oid, null) as elem_name
+                from pg_catalog.pg_type t
+                    left join pg_catalog.pg_type e
+                        on (e.oid = t.typelem and t.typcategory = 'A')
+                where t.oid = %s
+            """, (oid,))
+        t = cur.fetchone()
+        cur.close()
+
+        if t is None:
+            return None, None
+
+        if t.typtype == 'c':
+            return self._register_composite(t.type_name, con).typecaster, \
+                   t.type_name
+
+        if t.elem_typtype == 'c':
+            return self._register_composite(t.elem_name, con).array_typecaster, \
+                   t.type_name
+
+        if t.elem_typtype == 'd':
+            base_type_adaptor = psycopg2.extensions.string_types.get(
+                                                        t.elem_basetype)
+            if base_type_adaptor:
+                caster = psycopg2.extensions.new_array_type(
+                                (oid,), t.type_name, base_type_adaptor)
+                psycopg2.extensions.register_type(caster)
+                return caster, t.type_name
+
+        # Enums and such; psycopg2's default of str is just fine.
+        return None, t.type_name
+
+    def _register_composite(self, type_name, con):
+        caster = psycopg2.extras.register_composite(
+                                type_name, con, globally=True,
+                                factory=FastCompositeCaster)
+
+        # Registered both the composite and its array type at once.
+        self._versions[caster.oid] = self.version + 1
+        self._resolved[caster.oid] = caster.typecaster
+        if caster.array_oid:
+            self._versions[caster.array_oid] = self.version + 1
+            self._resolved[caster.array_oid] = caster.array_typecaster
+
+        return caster
+
+
+# The process-wide registry used by LazyTypeCursor.
+lazy_types = LazyTypeRegistry()
+
+
+class LazyTypeCursor(RowCursor):
+    # RowCursor which, upon seeing a result column of a not-yet
+    # registered custom type, has lazy_types resolve and register it,
+    # casting this first result's values itself (psycopg2 having
+    # already settled on str for them). Later results get psycopg2's
+    # native casting.
+
+    def execute(self, query, vars=None):
+        # Types resolved by now are cast natively by psycopg2.
+        self._jlr_types_version = lazy_types.version
+
+        return super().execute(query, vars)
+
+    def _resolve_row_maker(self):
+        make = super()._resolve_row_maker()
+
+        late = lazy_types.late_casts(self)
+        if not late:
+            return make
+
+        def late_cast(row):
+            values = list(row)
+            for i, caster in late:
+                # Named cursors re-cast each fetched batch, so may already
+                # be getting natively cast values.
+                if isinstance(values[i], str):
+                    values[i] = caster(values[i], self)
+
+            return make(values) if make is not None else tuple(values)
+
+        return late_cast
+
+
+def _cursor_factory_for(register_types):
+    if register_types == 'lazy':
+        return LazyTypeCursor
+
+    return RowCursor
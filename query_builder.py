@@ -1,13 +1,22 @@
-import collections
+import base64
+import collections.abc
+import copy
+import json
+import re
 
 class QueryBuilder:
     ###
     # Build up a SELECT programmatically.
     ###
 
-    def __init__(self, toplevel_clause=None, kind='SELECT'):
+    def __init__(self, toplevel_clause=None, kind='SELECT',
+                 normalize_in_lists=False):
         self._kind = kind
 
+        # Opt-in rewriting of "in %s" tuple parameters to "= any(%s)".
+        # See normalize_in_lists().
+        self._normalize_in_lists = normalize_in_lists
+
         if not toplevel_clause:
             toplevel_clause = AND()
         self._where = toplevel_clause
@@ -21,11 +30,56 @@ class QueryBuilder:
         self._having = []
         self._having_params = []
 
+        # ORDER BY terms, and the keyset (seek) pagination position
+        # within that ordering, if any. See after().
+        self._order_by = []
+        self._after = None
+
         self._limit = None
         self._offset = None
 
         self._relation_aliases = set()
 
+        # Rendered JOIN clauses and their params, cached until the
+        # next join(). See _join_fragments().
+        self._join_sql = None
+        self._join_params = None
+
+        # Names of the container attributes currently shared with a
+        # fork()ed relative, which must be copied before mutating.
+        self._shared = frozenset()
+
+    def fork(self):
+        ###
+        # Cheap copy for deriving variants of a 'base' query:
+        #
+        #   base = QueryBuilder().relation('document d') \
+        #               .where('d.tenant_id = %s', tenant_id) ...
+        #
+        #   emails = base.fork().where('d.storage_type = %s', 'email')
+        #
+        # Parent and child share all their lists (and already-rendered
+        # fragments) until one of them mutates one, at which point just
+        # that one list is copied. So a fork costs O(1), and rendering
+        # the child only pays for the clauses added since.
+        ###
+        child = copy.copy(self)
+        self._shared = child._shared = _COPY_ON_WRITE_ATTRS
+
+        return child
+
+    def _writable(self, attr):
+        # Return attr's container, first copying it if still shared
+        # with a fork()ed relative.
+        value = getattr(self, attr)
+
+        if attr in self._shared:
+            value = value.copy()
+            setattr(self, attr, value)
+            self._shared = self._shared - {attr}
+
+        return value
+
     def relation(self, main_relation_to_query):
         self._main_relation = main_relation_to_query
         self._scan_alias(main_relation_to_query)
@@ -43,7 +97,8 @@ class QueryBuilder:
         # add the same join in order to ultimately add in additional
         # where clauses happen w/o additional communication.
         if join_tuple not in self._joins:
-            self._joins.append(join_tuple)
+            self._writable('_joins').append(join_tuple)
+            self._join_sql = self._join_params = None
             self._scan_alias(relation)
 
         return self
@@ -61,33 +116,91 @@ class QueryBuilder:
                           kind='FULL OUTER', params=params)
 
     def project(self, *args):
-        self._projections.extend(args)
+        self._writable('_projections').extend(args)
         return self
 
     def having(self, expression, *params):
-        self._having.append(expression)
-        self._having_params.extend(params)
+        self._writable('_having').append(expression)
+        self._writable('_having_params').extend(params)
         return self
 
     def group_by(self, *args):
-        self._group_by.extend(args)
+        self._writable('_group_by').extend(args)
         return self
 
     def where(self, *args):
-        self._where.append(args)
+        self._writable('_where').append(args)
+        return self
+
+    def order_by(self, *args):
+        # Terms as in 'd.created desc', 'd.id'.
+        self._writable('_order_by').extend(args)
+        return self
+
+    def after(self, cursor_values):
+        ###
+        # Keyset (seek) pagination: restrict to the rows sorting after
+        # cursor_values in the order_by() ordering, as in
+        #
+        #   .order_by('d.created desc', 'd.id').after((created, id)) \
+        #   .limit(100)
+        #
+        # which costs the same for page 1000 as page 1 given an index
+        # matching the ordering, unlike OFFSET. cursor_values is either
+        # the sort key values of the prior page's last row, or the
+        # opaque token from page_token(). None starts from the top.
+        #
+        # The order_by() terms must be plain column references, non-null
+        # and together unique, lest rows be skipped or repeated across
+        # pages. The restriction goes into the WHERE clause (HAVING if
+        # grouped), its parameters after those of the rest of that
+        # clause.
+        ###
+        if isinstance(cursor_values, str):
+            cursor_values = decode_page_token(cursor_values)
+        elif cursor_values is not None:
+            cursor_values = tuple(cursor_values)
+
+        self._after = cursor_values
         return self
 
+    def page_token(self, row):
+        ###
+        # Opaque token for the page following the one ending with row,
+        # for passing back into after(). row must have attributes named
+        # as the order_by() columns (sans any table alias), as do
+        # namedtuple or slots rows.
+        ###
+        return encode_page_token(self._keyset_values(row))
+
+    def _keyset_values(self, row, names=None):
+        # row's values for the order_by() columns: by attribute, else
+        # (as for plain tuple rows) by position among names, the
+        # result's column names.
+        values = []
+        for expression, _ in self._order_by_terms():
+            column = _order_by_column_name(expression)
+            if hasattr(row, column):
+                values.append(getattr(row, column))
+            elif names is not None and column in names:
+                values.append(row[names.index(column)])
+            else:
+                raise ValueError('Row lacks order_by() column %s' % (column,))
+
+        return tuple(values)
+
     def limit(self, value: int, offset=None):
-        assert isinstance(value, int)
-        assert isinstance(offset, int) or offset is None
-        assert value >= 0
+        assert isinstance(value, Param) or \
+                    (isinstance(value, int) and value >= 0)
+        assert isinstance(offset, (int, Param)) or offset is None
 
         self._limit = value
         self._offset = offset
         return self
 
     def offset(self, offset):
-        assert isinstance(offset, int) and offset > 0
+        assert isinstance(offset, Param) or \
+                    (isinstance(offset, int) and offset > 0)
         assert self._limit is not None
         self._offset = offset
 
@@ -95,6 +208,21 @@ class QueryBuilder:
 
     @property
     def statement(self):
+        if self._normalize_in_lists:
+            return normalize_in_lists(self._render_statement(),
+                                      self._render_parameters())[0]
+
+        return self._render_statement()
+
+    @property
+    def parameters(self):
+        if self._normalize_in_lists:
+            return normalize_in_lists(self._render_statement(),
+                                      self._render_parameters())[1]
+
+        return self._render_parameters()
+
+    def _render_statement(self):
         assert self._projections
 
         buf = [self._kind]
@@ -106,21 +234,15 @@ class QueryBuilder:
 
         if self._joins:
             assert self._main_relation, 'Can only join given a main relation'
-            for relation, on, using, kind, params in self._joins:
-                how_expression = on or using
-                assert how_expression
-                if on:
-                    assert not using
-                    how = 'ON'
-                else:
-                    assert using
-                    how = 'USING'
+            buf.append(self._join_fragments()[0])
 
-                buf.append('%s JOIN %s %s (%s)' % (
-                            kind, relation, how, how_expression))
+        keyset = self._keyset_fragment()[0] if self._after is not None else None
 
-
-        if self._where.expression:
+        if keyset and not self._group_by:
+            where = self._where.expression
+            buf.append('WHERE')
+            buf.append('(%s) AND (%s)' % (where, keyset) if where else keyset)
+        elif self._where.expression:
             buf.append('WHERE')
             buf.append(self._where.expression)
 
@@ -129,10 +251,18 @@ class QueryBuilder:
             buf.append('GROUP BY')
             buf.append(', '.join(str(gb) for gb in self._group_by))
 
-        if self._having_params:
+        if keyset and self._group_by:
+            having = ' AND '.join('(%s)' % h for h in self._having)
+            buf.append('HAVING')
+            buf.append('%s AND (%s)' % (having, keyset) if having else keyset)
+        elif self._having_params:
             buf.append('HAVING')
             buf.append(', '.join(str(h) for h in self._having))
 
+        if self._order_by:
+            buf.append('ORDER BY')
+            buf.append(', '.join(self._order_by))
+
         if self._limit:
             buf.append('LIMIT %s')
         if self._offset:
@@ -140,23 +270,19 @@ class QueryBuilder:
 
         return ' '.join(buf)
 
-    @property
-    def parameters(self):
-        params = []
-
-        # join params are buried as the last member of
-        # the _joins tuples. See .join().
-        for j in self._joins:
-            join_params = j[-1]
-            if join_params:
-                if isinstance(join_params, tuple):
-                    params.extend(join_params)
-                else:
-                    params.append(join_params)
+    def _render_parameters(self):
+        params = list(self._join_fragments()[1])
 
         params.extend(self._where.parameters)
+
+        if self._after is not None and not self._group_by:
+            params.extend(self._keyset_fragment()[1])
+
         params.extend(self._having_params)
 
+        if self._after is not None and self._group_by:
+            params.extend(self._keyset_fragment()[1])
+
         if self._limit:
             params.append(self._limit)
             if self._offset:
@@ -164,6 +290,112 @@ class QueryBuilder:
 
         return tuple(params)
 
+    def compile(self):
+        ###
+        # Snapshot the current statement and parameters into an immutable
+        # QueryTemplate. Any Param('name') placeholders passed in as
+        # parameter values become named slots, to be filled in per
+        # execution via template.bind(name=value, ...) without having
+        # to rebuild or re-walk this builder.
+        ###
+        return QueryTemplate(self.statement, self.parameters)
+
+    def _join_fragments(self):
+        # (rendered JOIN clauses, tuple of their params), cached.
+        if self._join_sql is None:
+            buf = []
+            params = []
+
+            for relation, on, using, kind, join_params in self._joins:
+                how_expression = on or using
+                assert how_expression
+                if on:
+                    assert not using
+                    how = 'ON'
+                else:
+                    assert using
+                    how = 'USING'
+
+                buf.append('%s JOIN %s %s (%s)' % (
+                            kind, relation, how, how_expression))
+
+                # join params are buried as the last member of
+                # the _joins tuples. See .join().
+                if join_params:
+                    if isinstance(join_params, tuple):
+                        params.extend(join_params)
+                    else:
+                        params.append(join_params)
+
+            self._join_sql = ' '.join(buf)
+            self._join_params = tuple(params)
+
+        return self._join_sql, self._join_params
+
+    def _order_by_terms(self):
+        # [(expression, is descending)] for each order_by() term.
+        terms = []
+        for term in self._order_by:
+            match = _ORDER_BY_TERM_RE.match(term)
+            if not match:
+                raise ValueError('Keyset pagination needs plain "expression'
+                                 ' [asc|desc] [nulls first|last]" order_by()'
+                                 ' terms, not %r' % (term,))
+            direction = match.group(2)
+            terms.append((match.group(1), bool(direction)
+                                          and direction.lower() == 'desc'))
+
+        return terms
+
+    def _keyset_fragment(self):
+        ###
+        # (expression, params) selecting rows after self._after in the
+        # order_by() ordering. A single row-value comparison when all
+        # terms sort the same direction, which postgres can drive off
+        # of a multicolumn index:
+        #
+        #   (d.created, d.id) > (%s, %s)
+        #
+        # otherwise the expanded equivalent, as in
+        #
+        #   d.created <= %s AND ((d.created < %s)
+        #                           OR (d.created = %s AND d.id > %s))
+        #
+        # whose redundant leading bound lets an index on the first term
+        # drive the scan, as the OR alone can't.
+        ###
+        terms = self._order_by_terms()
+
+        if len(terms) != len(self._after):
+            raise ValueError('Expected %d keyset values for order_by() %s,'
+                             ' got %d' % (len(terms), self._order_by,
+                                          len(self._after)))
+
+        expressions = [expression for expression, _ in terms]
+        descending = [desc for _, desc in terms]
+
+        if len(set(descending)) == 1:
+            op = '<' if descending[0] else '>'
+            if len(terms) == 1:
+                return '%s %s %%s' % (expressions[0], op), tuple(self._after)
+
+            return ('(%s) %s (%s)' % (', '.join(expressions), op,
+                                     ', '.join(['%s'] * len(terms))),
+                    tuple(self._after))
+
+        clauses = []
+        params = [self._after[0]]
+        for i, (expression, desc) in enumerate(terms):
+            equal_prefix = ['%s = %%s' % e for e in expressions[:i]]
+            clauses.append('(%s)' % ' AND '.join(
+                    equal_prefix + ['%s %s %%s' % (expression,
+                                                   '<' if desc else '>')]))
+            params.extend(self._after[:i + 1])
+
+        bound = '%s %s %%s' % (expressions[0], '<=' if descending[0] else '>=')
+
+        return '%s AND (%s)' % (bound, ' OR '.join(clauses)), tuple(params)
+
     def _scan_alias(self, relation_expr):
         assert '"' not in relation_expr, \
             'Not smart enough for quoted relations, masochist!'
@@ -176,24 +408,184 @@ class QueryBuilder:
             relation, alias = relation_expr.split(' ')
             if alias in self._relation_aliases:
                 raise AliasException('Already using relation alias %s' % alias)
-            self._relation_aliases.add(alias)
+            self._writable('_relation_aliases').add(alias)
+
+# "in" or "not in" immediately preceding a placeholder.
+_IN_BEFORE_PLACEHOLDER_RE = re.compile(r'(?i)(?<![\w.])(not\s+)?in\s*$')
+
+_PLACEHOLDER_RE = re.compile(r'%%|%s')
+
+
+def normalize_in_lists(statement: str, parameters: tuple):
+    ###
+    # Rewrite each "in %s" (or "not in %s") whose parameter is a tuple
+    # or list into "= any(%s)" (or "<> all(%s)") with a list parameter,
+    # which psycopg2 then passes as a single array:
+    #
+    #   ('id in %s', ((1, 2, 3),))  ->  ('id = any(%s)', ([1, 2, 3],))
+    #
+    # psycopg2 expands a tuple into a literal "(1, 2, 3)", so the plain
+    # spelling yields a different statement text for every list length,
+    # defeating prepared statements and fragmenting pg_stat_statements.
+    # (Also empty tuples then work, instead of being a syntax error.)
+    #
+    # Returns the (statement, parameters) pair.
+    ###
+    parameters = list(parameters)
+
+    buf = []
+    copied_up_to = 0
+    param_index = 0
+
+    for match in _PLACEHOLDER_RE.finditer(statement):
+        if match.group(0) == '%%':
+            continue
+
+        param = parameters[param_index]
+
+        if isinstance(param, (tuple, list)):
+            in_match = _IN_BEFORE_PLACEHOLDER_RE.search(
+                            statement, max(0, match.start() - 32),
+                            match.start())
+            if in_match:
+                buf.append(statement[copied_up_to:in_match.start()])
+                buf.append('<> all(%s)' if in_match.group(1) else '= any(%s)')
+                copied_up_to = match.end()
+
+                parameters[param_index] = list(param)
+
+        param_index += 1
+
+    buf.append(statement[copied_up_to:])
+
+    return ''.join(buf), tuple(parameters)
+
+
+# QueryBuilder members shared between fork()ed relatives until written.
+_COPY_ON_WRITE_ATTRS = frozenset(('_where', '_projections', '_joins',
+                                  '_group_by', '_having', '_having_params',
+                                  '_order_by', '_relation_aliases'))
+
+# An order_by() term usable for keyset pagination: expression, then
+# optional direction, then optional NULLS FIRST / LAST. The latter is
+# moot to the keyset, as its columns must be non-null anyway.
+_ORDER_BY_TERM_RE = re.compile(
+        r'(?i)^\s*(.+?)(?:\s+(asc|desc))?(?:\s+nulls\s+(?:first|last))?\s*$')
+
+
+def _order_by_column_name(expression):
+    # 'd.created' -> 'created'
+    return expression.rsplit('.', 1)[-1].strip()
+
+
+def encode_page_token(values):
+    ###
+    # Opaque, url-safe keyset pagination token for a row's sort key
+    # values. Values not native to JSON (datetimes, Decimals, UUIDs)
+    # go in as strings, which postgres happily coerces back when
+    # compared against the column.
+    ###
+    encoded = json.dumps(list(values), default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(encoded.encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except ValueError:
+        raise ValueError('Invalid page token %r' % (token,))
+
+    if not isinstance(values, list):
+        raise ValueError('Invalid page token %r' % (token,))
+
+    return tuple(values)
+
 
 class AliasException(Exception):
     pass
 
+
+class Param:
+    ###
+    # Named placeholder for a parameter value not known until execution
+    # time, as in .where('document_id = %s', Param('document_id')).
+    # Filled in by QueryTemplate.bind(). See QueryBuilder.compile().
+    ###
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Param) and other.name == self.name
+
+    def __hash__(self):
+        return hash((Param, self.name))
+
+    def __repr__(self):
+        return 'Param(%r)' % (self.name,)
+
+
+class QueryTemplate:
+    ###
+    # Compiled, immutable form of a QueryBuilder: the finished statement
+    # text, plus parameters with Param slots to be bound per execution.
+    #
+    #   DOCS_BY_TYPE = QueryBuilder().relation('document') \
+    #                       .project('document_id') \
+    #                       .where('storage_type = %s', Param('type')) \
+    #                       .compile()
+    #
+    #   ...
+    #   query(con, DOCS_BY_TYPE.statement, DOCS_BY_TYPE.bind(type='email'))
+    ###
+    __slots__ = ('_statement', '_parameters', '_slots', '_slot_names')
+
+    def __init__(self, statement: str, parameters: tuple):
+        object.__setattr__(self, '_statement', statement)
+        object.__setattr__(self, '_parameters', tuple(parameters))
+
+        # (position, name) of each Param slot within parameters.
+        slots = tuple((i, p.name) for i, p in enumerate(parameters)
+                      if isinstance(p, Param))
+        object.__setattr__(self, '_slots', slots)
+        object.__setattr__(self, '_slot_names',
+                           frozenset(name for _, name in slots))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('QueryTemplate is immutable')
+
+    @property
+    def statement(self):
+        return self._statement
+
+    @property
+    def parameter_names(self):
+        return self._slot_names
+
+    def bind(self, **values):
+        # Fill in the Param slots, returning the parameter tuple.
+        if values.keys() != self._slot_names:
+            raise TypeError('Expected parameters %s, got %s' % (
+                        sorted(self._slot_names), sorted(values)))
+
+        if not self._slots:
+            return self._parameters
+
+        params = list(self._parameters)
+        for position, name in self._slots:
+            params[position] = values[name]
+
+        return tuple(params)
+
+    def __repr__(self):
+        return 'QueryTemplate(%r, %r)' % (self._statement, self._parameters)
+
 class ExpressionAndParams:
     def __init__(self, operator: str, operands):
         self.operator = operator
         self._operands = []
 
-        if operands:
-            assert isinstance(operands, collections.Sequence) \
-                and not isinstance(operands, str)
-
-            for op in operands:
-                # make use of member-wise check in this method.
-                self.append(op)
-
         # String, as in '(foo=%s) AND (bar like %s)', determined very late
         # in _expand() when diven by 1st dereference to either
         # .expression or .parameters properties.
@@ -204,6 +596,14 @@ class ExpressionAndParams:
         # .expression or .parameters properties.
         self._parameters = None
 
+        if operands:
+            assert isinstance(operands, collections.abc.Sequence) \
+                and not isinstance(operands, str)
+
+            for op in operands:
+                # make use of member-wise check in this method.
+                self.append(op)
+
 
     def append(self, *args):
         # args should be one of:
@@ -260,6 +660,36 @@ class ExpressionAndParams:
             raise TypeError("Don't know how to handle %r: %s %s" %
                     (args, len(args), isinstance(args[0], str),))
 
+        # Fold the new operand into any prior expansion, rather than
+        # invalidating it, so an append costs only the new clause.
+        # Must spell exactly what _expand() would.
+        if self._expression is not None:
+            new = self._operands[-1]
+            if isinstance(new, tuple):
+                new_expression, new_params = new
+            else:
+                new_expression, new_params = new.expression, new.parameters
+
+            if len(self._operands) == 1:
+                self._expression = new_expression
+            else:
+                spaced_op = ' %s ' % self.operator
+                if len(self._operands) == 2:
+                    prior = '(' + self._expression + ')'
+                else:
+                    prior = self._expression
+                self._expression = prior + spaced_op + '(' + new_expression + ')'
+
+            self._parameters = self._parameters + list(new_params)
+
+    def copy(self):
+        # Shallow copy: own operand list, shared operands (and any
+        # already-expanded expression / parameters).
+        other = copy.copy(self)
+        other._operands = list(self._operands)
+
+        return other
+
 
     @property
     def expression(self):
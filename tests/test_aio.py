@@ -0,0 +1,75 @@
+import asyncio
+import os
+
+import psycopg2.errors
+import pytest
+
+from jlr import aio
+
+
+# Needs a scratch postgres database, as in
+#   JLR_TEST_DSN='postgresql://postgres@/postgres?host=/tmp' pytest
+DSN = os.environ.get('JLR_TEST_DSN')
+
+pytestmark = pytest.mark.skipif(not DSN, reason='JLR_TEST_DSN not set')
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_query_helpers():
+    async def go():
+        pool = aio.AsyncConnectionPool(DSN, max_size=2)
+        async with pool.connection() as con:
+            rows = await aio.query(con, 'select g as id from generate_series(1, 3) g')
+            assert [r.id for r in rows] == [1, 2, 3]
+
+            assert await aio.query_single_value(con, 'select %s + 1', (41,)) == 42
+            assert await aio.query_single_column(con, 'select g from generate_series(1, 2) g') == [1, 2]
+            assert (await aio.query_single_row(con, 'select 1 as a')).a == 1
+            assert await aio.query_as_json(con, 'select 1 as a', strategy='agg') == '[{"a":1}]'
+
+            qt = aio.QueryTool(con).project('g').relation('generate_series(1,5) g') \
+                        .where('g > %s', 3)
+            assert await qt.query_single_column() == [4, 5]
+
+        await pool.close()
+
+    run(go())
+
+def test_transactions_and_inserts():
+    async def go():
+        pool = aio.AsyncConnectionPool(DSN, max_size=2)
+        async with pool.connection() as con:
+            await aio.execute(con, 'create temporary table aio_test (id serial, name text)')
+
+            assert await aio.bulk_insert(con, 'aio_test',
+                                         [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}],
+                                         return_column='id', batch_size=2) == [1, 2, 3]
+
+            with pytest.raises(psycopg2.errors.DivisionByZero):
+                async with aio.transaction(con):
+                    await aio.insert(con, 'aio_test', {'name': 'rolled back'})
+                    await aio.query(con, 'select 1/0')
+
+            assert await aio.query_single_value(con, 'select count(*) from aio_test') == 3
+
+        await pool.close()
+
+    run(go())
+
+def test_pool_concurrency():
+    async def go():
+        pool = aio.AsyncConnectionPool(DSN, max_size=4)
+
+        async def one(i):
+            async with pool.connection() as con:
+                return await aio.query_single_value(con, 'select %s from pg_sleep(0.05)', (i,))
+
+        assert await asyncio.gather(*[one(i) for i in range(8)]) == list(range(8))
+        assert pool.size <= 4
+
+        await pool.close()
+
+    run(go())
@@ -0,0 +1,532 @@
+from jlr import db, sql
+from jlr.db import FastCompositeCaster, ManagedConnection
+
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import types
+
+import psycopg2.errors
+import psycopg2.extras
+import pytest
+
+
+# Replica routing tests need a scratch primary database plus another
+# standing in for its replica, as in
+#   JLR_TEST_DSN='postgresql://postgres@/postgres?host=/tmp'
+#   JLR_TEST_REPLICA_DSN='postgresql://postgres@/jlr_replica?host=/tmp'
+DSN = os.environ.get('JLR_TEST_DSN')
+REPLICA_DSN = os.environ.get('JLR_TEST_REPLICA_DSN')
+
+needs_db = pytest.mark.skipif(not DSN, reason='JLR_TEST_DSN not set')
+
+needs_replica = pytest.mark.skipif(not (DSN and REPLICA_DSN),
+                                   reason='JLR_TEST_DSN / JLR_TEST_REPLICA_DSN not set')
+
+# No server listens here.
+DOWN_DSN = 'postgresql://postgres@/nope?host=/nonexistent&connect_timeout=1'
+
+
+def test_fast_composite_tokenize_unquoted():
+
+    assert FastCompositeCaster.tokenize('(1,abc,2.5)') == ['1', 'abc', '2.5']
+
+    # Empty unquoted tokens are NULLs, including leading / trailing ones.
+    assert FastCompositeCaster.tokenize('(,abc,)') == [None, 'abc', None]
+
+    assert FastCompositeCaster.tokenize('()') == [None]
+
+def test_fast_composite_tokenize_quoted():
+
+    # Quoted empty string is not NULL.
+    assert FastCompositeCaster.tokenize('(1,"",)') == ['1', '', None]
+
+    assert FastCompositeCaster.tokenize('("a b","c,d","(e)")') == ['a b', 'c,d', '(e)']
+
+    # Doubled quotes and backslashes undoubled.
+    assert FastCompositeCaster.tokenize(r'("say ""hi""","back\\slash",x)') == \
+                ['say "hi"', 'back\\slash', 'x']
+
+    assert FastCompositeCaster.tokenize('(,"""",)') == [None, '"', None]
+
+def test_fast_composite_tokenize_matches_stock():
+    values = [
+        '(1,abc,2.5)',
+        '(,,)',
+        '("",,"")',
+        r'("a ""b"" \\c","d,e",f)',
+        '(x,"y)",z)',
+        '("(",")","\\\\")',
+    ]
+
+    for value in values:
+        assert FastCompositeCaster.tokenize(value) == \
+                psycopg2.extras.CompositeCaster.tokenize(value), value
+
+def test_fast_composite_parse_builds_namedtuple():
+    # All-text attributes need no cursor to cast.
+    caster = FastCompositeCaster('pair', 12345, [('a', 25), ('b', 1043)])
+
+    row = caster.parse('(x,"y z")', None)
+
+    assert row == ('x', 'y z')
+    assert row.a == 'x' and row.b == 'y z'
+    assert type(row).__name__ == 'pair'
+
+    assert caster.parse(None, None) is None
+
+
+def current_database(con):
+    cur = con.cursor()
+    cur.execute('select current_database()')
+    return cur.fetchone()[0]
+
+def replica_database():
+    con = psycopg2.connect(REPLICA_DSN)
+    try:
+        return current_database(con)
+    finally:
+        con.close()
+
+@needs_replica
+def test_read_only_transactions_routed_to_replica():
+    mc = ManagedConnection(DSN, None, replicas=[REPLICA_DSN])
+    replica = replica_database()
+
+    con = mc.begin_transaction()
+    assert current_database(con) != replica
+    mc.complete_transaction()
+
+    con = mc.begin_transaction(read_only=True)
+    assert current_database(con) == replica
+
+    # Replica sessions are read only.
+    cur = con.cursor()
+    with pytest.raises(psycopg2.errors.ReadOnlySqlTransaction):
+        cur.execute('create temporary table nope (id int)')
+    mc.complete_transaction()
+
+    # ... returned to the replica's pool, not the primary's.
+    assert mc.replicas.pools[0].idle_count == 1
+    assert mc.pool.idle_count == 1
+
+    mc.close()
+    mc.pool.closeall()
+
+@needs_replica
+def test_read_connection_within_primary_transaction():
+    mc = ManagedConnection(DSN, None, replicas=[REPLICA_DSN])
+
+    con = mc.begin_transaction()
+    read_con = mc.read_connection()
+    assert read_con is not con
+    assert current_database(read_con) == replica_database()
+    # Same one for the rest of the transaction.
+    assert mc.read_connection() is read_con
+
+    mc.complete_transaction()
+    assert mc.replicas.pools[0].idle_count == 1
+
+    # Only within a transaction, lest the replica connection be held
+    # indefinitely.
+    with pytest.raises(RuntimeError):
+        mc.read_connection()
+    assert mc.replicas.pools[0].idle_count == 1
+
+    # A read-only transaction reads on its own connection.
+    con = mc.begin_transaction(read_only=True)
+    assert mc.read_connection() is con
+    mc.complete_transaction()
+
+    mc.close()
+    mc.pool.closeall()
+
+@needs_replica
+def test_replica_selection():
+    router = db.ReplicaRouter([REPLICA_DSN, REPLICA_DSN], None)
+    pools = router.pools
+
+    # Round robin alternates which replica comes first ...
+    first_pools = []
+    for _ in range(4):
+        pool, con = router.getconn()
+        first_pools.append(pool)
+        pool.putconn(con)
+    assert first_pools == [pools[0], pools[1], pools[0], pools[1]]
+
+    # ... and skips those with no connection to spare.
+    router = db.ReplicaRouter([REPLICA_DSN, REPLICA_DSN], None, max_size=1)
+    pool_a, con_a = router.getconn()
+    pool_b, con_b = router.getconn()
+    assert pool_a is not pool_b
+    assert router.getconn() == (None, None)
+    pool_a.putconn(con_a)
+    pool_b.putconn(con_b)
+    router.closeall()
+
+    router = db.ReplicaRouter([REPLICA_DSN, REPLICA_DSN], None,
+                              selection='least_busy')
+    pool_a, con_a = router.getconn()
+    pool_b, con_b = router.getconn()
+    assert pool_a is not pool_b
+    pool_a.putconn(con_a)
+    pool, con = router.getconn()
+    assert pool is pool_a
+    pool.putconn(con)
+    pool_b.putconn(con_b)
+    router.closeall()
+
+    with pytest.raises(ValueError):
+        db.ReplicaRouter([REPLICA_DSN], None, selection='random')
+
+@needs_replica
+def test_replica_fallbacks():
+    # An unreachable replica is skipped for the next.
+    router = db.ReplicaRouter([DOWN_DSN, REPLICA_DSN], None)
+    for _ in range(2):
+        pool, con = router.getconn()
+        assert pool is router.pools[1]
+        pool.putconn(con)
+    router.closeall()
+
+    # A plain database isn't in recovery, so never lags.
+    router = db.ReplicaRouter([REPLICA_DSN], None, max_lag_secs=0)
+    pool, con = router.getconn()
+    assert con is not None
+    pool.putconn(con)
+    router.closeall()
+
+    # No usable replica, so read-only transactions fall back to the primary.
+    mc = ManagedConnection(DSN, None, replicas=[DOWN_DSN])
+    con = mc.begin_transaction(read_only=True)
+    assert current_database(con) == current_database(psycopg2.connect(DSN))
+    mc.complete_transaction()
+    assert mc.pool.idle_count == 1
+    mc.close()
+    mc.pool.closeall()
+
+def test_read_only_requests():
+    flask = pytest.importorskip('flask')
+
+    app = flask.Flask(__name__)
+
+    @app.route('/write')
+    def write():
+        pass
+
+    @app.route('/decorated')
+    @db.read_only
+    def decorated():
+        pass
+
+    @app.route('/flagged')
+    def flagged():
+        pass
+
+    def is_read_only(path, read_only_endpoints):
+        with app.test_request_context(path):
+            return db._is_read_only_request(app, read_only_endpoints)
+
+    assert not is_read_only('/write', None)
+    assert is_read_only('/decorated', None)
+    assert is_read_only('/flagged', {'flagged'})
+    assert not is_read_only('/write', {'flagged'})
+    assert is_read_only('/write', lambda request: request.path == '/write')
+    # Unrouted.
+    assert not is_read_only('/nope', {'flagged'})
+
+
+def test_type_cache_write_failure_is_not_fatal(tmp_path, monkeypatch, caplog):
+    con = types.SimpleNamespace(info=types.SimpleNamespace(
+                                    host='/tmp', port=5432, dbname='x'))
+
+    # Missing directory.
+    db._write_type_cache(str(tmp_path / 'nope' / 'types.json'), con, {}, 'f')
+    assert 'Could not write type cache' in caplog.text
+
+    # Failing rename leaves no temp file behind.
+    def failing_replace(src, dst):
+        raise PermissionError(13, 'Permission denied')
+
+    monkeypatch.setattr(os, 'replace', failing_replace)
+    db._write_type_cache(str(tmp_path / 'types.json'), con, {}, 'f')
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.fixture
+def resolutions(monkeypatch):
+    # Swap in a fresh registry whose hook records first-sight resolutions.
+    resolutions = []
+    monkeypatch.setattr(db, 'lazy_types', db.LazyTypeRegistry(
+                hook=lambda *args: resolutions.append(args)))
+    return resolutions
+
+
+@pytest.fixture
+def lazy_con(resolutions):
+    # Types are created per test, under unique names, and rolled back.
+    con = psycopg2.connect(DSN, cursor_factory=db.LazyTypeCursor)
+    yield con
+    con.rollback()
+    con.close()
+
+
+def _unique_name(prefix):
+    # psycopg2's typecasters are registered globally, so never reuse a
+    # type name within the process.
+    return '%s_%d_%d' % (prefix, os.getpid(), time.monotonic_ns())
+
+
+def _lazy_fetch(con, query):
+    cur = con.cursor()
+    cur.execute(query)
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+@needs_db
+def test_lazy_types_first_sight_composite(lazy_con):
+    name = _unique_name('jlr_pair')
+    sql.execute(lazy_con, 'create type %s as (a int, b text)' % name)
+    query = "select row(1, 'x')::%s as p" % name
+
+    # First sight: cast by LazyTypeCursor itself ...
+    (row,) = _lazy_fetch(lazy_con, query)
+    assert (row.p.a, row.p.b) == (1, 'x')
+    assert db.lazy_types.version == 1
+
+    # ... later on natively, with no further resolving.
+    (row,) = _lazy_fetch(lazy_con, query)
+    assert (row.p.a, row.p.b) == (1, 'x')
+    assert db.lazy_types.version == 1
+
+
+@needs_db
+def test_lazy_types_resolved_after_execute(lazy_con):
+    name = _unique_name('jlr_pair')
+    sql.execute(lazy_con, 'create type %s as (a int, b text)' % name)
+    query = "select row(2, 'y')::%s as p" % name
+
+    # Executed before the other cursor's fetch resolved the type, so
+    # psycopg2 still hands this one strings to be cast late.
+    early = lazy_con.cursor()
+    early.execute(query)
+    assert _lazy_fetch(lazy_con, query)[0].p.a == 2
+
+    row = early.fetchone()
+    assert (row.p.a, row.p.b) == (2, 'y')
+
+
+@needs_db
+def test_lazy_types_array_of_composite(lazy_con, resolutions):
+    name = _unique_name('jlr_pair')
+    sql.execute(lazy_con, 'create type %s as (a int, b text)' % name)
+
+    (row,) = _lazy_fetch(lazy_con, "select array[row(1, 'x')::%s,"
+                                   " row(2, null)]::%s[] as ps" % (name, name))
+    assert [(p.a, p.b) for p in row.ps] == [(1, 'x'), (2, None)]
+
+    # Registered the composite itself along the way.
+    (row,) = _lazy_fetch(lazy_con, "select row(3, 'z')::%s as p" % name)
+    assert (row.p.a, row.p.b) == (3, 'z')
+    assert len(resolutions) == 1
+
+
+@needs_db
+def test_lazy_types_domain_array(lazy_con):
+    name = _unique_name('jlr_count')
+    sql.execute(lazy_con, 'create domain %s as int check (value >= 0)' % name)
+
+    (row,) = _lazy_fetch(lazy_con, 'select array[1, 2]::%s[] as ns' % name)
+    assert row.ns == [1, 2]
+
+    (row,) = _lazy_fetch(lazy_con, 'select array[3]::%s[] as ns' % name)
+    assert row.ns == [3]
+
+
+@needs_db
+def test_lazy_types_hook(lazy_con, resolutions):
+    name = _unique_name('jlr_pair')
+    sql.execute(lazy_con, 'create type %s as (a int, b text)' % name)
+    sql.execute(lazy_con, "create type %s_mood as enum ('ok')" % name)
+
+    for _ in range(2):
+        _lazy_fetch(lazy_con, "select row(1, 'x')::%s as p,"
+                              " 'ok'::%s_mood as m" % (name, name))
+
+    # Once per type, enums included though they need no typecaster.
+    assert [r[1] for r in resolutions] == [name, name + '_mood']
+    oid = sql.query_single_value(lazy_con, 'select %s::regtype::oid', (name,))
+    assert resolutions[0][0] == oid
+    assert all(r[2] >= 0 for r in resolutions)
+
+
+@needs_db
+def test_pool_grows_reuses_and_evicts():
+    pool = db.ConnectionPool(DSN, None, min_size=1, max_size=3,
+                             idle_timeout_secs=60)
+
+    a, b, c = pool.getconn(), pool.getconn(), pool.getconn()
+    assert pool.size == 3 and pool.idle_count == 0
+
+    for con in (a, b, c):
+        pool.putconn(con)
+
+    # Most recently returned first.
+    assert pool.getconn() is c
+    pool.putconn(c)
+
+    # Not yet idle long enough.
+    pool.evict_idle()
+    assert pool.size == 3
+
+    pool.idle_timeout_secs = 0
+    time.sleep(0.01)
+    pool.evict_idle()
+    # Stalest first, down to min_size.
+    assert pool.size == 1 and pool.idle_count == 1
+    assert a.closed and b.closed and not c.closed
+
+    # Closed out from under the pool: replaced upon checkout.
+    c.close()
+    con = pool.getconn()
+    assert con is not c and not con.closed and pool.size == 1
+
+    pool.putconn(con, close=True)
+    assert pool.size == 0 and con.closed
+
+    pool.closeall()
+
+@needs_db
+def test_pool_waiting():
+    pool = db.ConnectionPool(DSN, None, max_size=1, checkout_timeout_secs=5,
+                             max_waiting=1)
+    con = pool.getconn()
+
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+    waiter.start()
+    time.sleep(0.1)
+
+    # Only one may wait at a time.
+    with pytest.raises(db.PoolExhaustedException, match='already waiting'):
+        pool.getconn()
+
+    # The waiter is handed the returned connection.
+    pool.putconn(con)
+    waiter.join(5)
+    assert got == [con]
+
+    # Nothing returned in time.
+    started = time.time()
+    with pytest.raises(db.PoolExhaustedException, match='Timed out'):
+        pool.getconn(timeout_secs=0.1)
+    assert 0.1 <= time.time() - started < 1
+
+    pool.putconn(con)
+    pool.closeall()
+
+
+@needs_db
+def test_gather():
+    mc = ManagedConnection(DSN, None, max_connections=4)
+
+    def sleeper(n):
+        return sql.QueryTool(None, row_mode='tuple') \
+                    .project('%d as n' % n, 'pg_sleep(0.3)')
+
+    started = time.time()
+    results = mc.gather(sleeper(1), sleeper(2),
+                        (sql.QueryTool(None).project(
+                            "current_setting('transaction_read_only')"),
+                         'query_single_value'))
+    # Concurrently, not one after the other.
+    assert time.time() - started < 0.8
+
+    assert results == [[(1, '')], [(2, '')], 'on']
+    assert mc.pool.size == mc.pool.idle_count == 3
+
+    # One imported snapshot for all.
+    snapshot = sql.QueryTool(None, row_mode='tuple').project(
+                    'pg_current_snapshot()::text',
+                    "current_setting('transaction_isolation')")
+    first, second = mc.gather((snapshot, 'query_single_row'),
+                              (snapshot.fork(), 'query_single_row'),
+                              snapshot=True)
+    assert first == second and first[1] == 'repeatable read'
+
+    # A failure is raised, after all have finished and returned their
+    # connections.
+    failing = sql.QueryTool(None).project('1 / 0')
+    with pytest.raises(psycopg2.errors.DivisionByZero):
+        mc.gather(sleeper(1), failing, snapshot=True)
+    assert mc.pool.size == mc.pool.idle_count
+
+    mc.close()
+    mc.pool.closeall()
+
+
+# Monkey patching is for keeps, so green mode is tried in a subprocess.
+GREEN_SCRIPT = textwrap.dedent('''
+    import sys, time
+    green, dsn = sys.argv[1:]
+
+    if green == 'gevent':
+        import gevent, gevent.monkey
+        gevent.monkey.patch_all()
+        def run_all(funcs):
+            gevent.joinall([gevent.spawn(f) for f in funcs], raise_error=True)
+    else:
+        import eventlet
+        eventlet.monkey_patch()
+        def run_all(funcs):
+            pool = eventlet.GreenPool()
+            for t in [pool.spawn(f) for f in funcs]:
+                t.wait()
+
+    from jlr import db, sql
+
+    db.make_green(green)
+    db.configure(dsn, green=green, max_connections=10)
+
+    pids = set()
+
+    @db.mc.with_transaction
+    def handler(con):
+        pids.add(sql.query_single_value(con,
+                    'select pg_backend_pid() from pg_sleep(0.2)'))
+
+    started = time.time()
+    run_all([handler] * 10)
+    elapsed = time.time() - started
+    # Each greenlet on its own connection, waiting on the server together.
+    assert len(pids) == 10, pids
+    assert elapsed < 1, elapsed
+
+    @db.mc.with_transaction
+    def copy_free(con):
+        sql.execute(con, 'create temporary table t (id int primary key, v text)')
+        assert sql.bulk_upsert(con, 't', [{'id': i, 'v': 'x'} for i in range(5)],
+                               'id', staging_threshold=1) == (5, 0)
+        assert len(sql.query_by_keys(con, 't', 'id', [1, 2, 3],
+                                     strategy='temp_table', chunk_size=1)) == 3
+
+    copy_free()
+    print('ok')
+''')
+
+
+@needs_db
+@pytest.mark.parametrize('green', ['gevent', 'eventlet'])
+def test_green_mode(green):
+    pytest.importorskip(green)
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    result = subprocess.run([sys.executable, '-c', GREEN_SCRIPT, green, DSN],
+                            capture_output=True, text=True, env=env, timeout=60)
+
+    assert result.stdout.strip() == 'ok', result.stderr
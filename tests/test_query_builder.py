@@ -1,4 +1,5 @@
-from jlr.query_builder import QueryBuilder, AND, OR, AliasException
+from jlr.query_builder import QueryBuilder, AND, OR, AliasException, Param, normalize_in_lists, \
+		decode_page_token
 
 
 
@@ -272,3 +273,256 @@ def test_second_call_to_relation_overwrites():
 		'Statement was: %s'  % qb.statement
 
 
+
+def test_compile_binds_named_params():
+	template = QueryBuilder() \
+		.relation('document d') \
+		.join('document_comment dc', on='dc.document_id = d.document_id and dc.author = %s',
+					params=Param('author')) \
+		.project('d.document_id') \
+		.where('d.storage_type = %s', 'email') \
+		.where('d.document_id > %s', Param('after')) \
+		.limit(Param('limit')) \
+		.compile()
+
+	assert template.statement == \
+		'SELECT d.document_id FROM document d' \
+		' INNER JOIN document_comment dc' \
+		' ON (dc.document_id = d.document_id and dc.author = %s)' \
+		' WHERE (d.storage_type = %s) AND (d.document_id > %s) LIMIT %s', template.statement
+
+	assert template.parameter_names == {'author', 'after', 'limit'}
+
+	# Params land in statement order, not funcall or kwarg order.
+	assert template.bind(limit=10, after=500, author='joe') == ('joe', 'email', 500, 10)
+	assert template.bind(limit=5, after=1, author='sue') == ('sue', 'email', 1, 5)
+
+def test_compile_without_params():
+	template = QueryBuilder().relation('document').project('count(*)') \
+				.where('storage_type = %s', 'email').compile()
+
+	assert template.bind() == ('email',)
+
+def test_bind_rejects_missing_or_extra_names():
+	template = QueryBuilder().relation('document').project('document_id') \
+				.where('document_id = %s', Param('id')).compile()
+
+	for bad in ({}, {'id': 1, 'other': 2}, {'other': 2}):
+		try:
+			template.bind(**bad)
+			raised = False
+		except TypeError:
+			raised = True
+
+		assert raised, 'Should have balked at %r' % (bad,)
+
+def test_compiled_template_unaffected_by_later_builder_changes():
+	qb = QueryBuilder().relation('document').project('document_id') \
+				.where('document_id = %s', Param('id'))
+	template = qb.compile()
+
+	qb.where('storage_type = %s', 'email')
+
+	assert template.statement == 'SELECT document_id FROM document WHERE document_id = %s'
+	assert template.bind(id=3) == (3,)
+
+	try:
+		template._statement = 'DROP TABLE document'
+		raised = False
+	except AttributeError:
+		raised = True
+
+	assert raised, 'QueryTemplate should be immutable'
+
+def test_where_after_statement_rendered():
+	qb = QueryBuilder().relation('document').project('document_id') \
+				.where('document_id > %s', 5)
+
+	assert qb.statement == 'SELECT document_id FROM document WHERE document_id > %s'
+
+	qb.where('storage_type = %s', 'email')
+
+	assert qb.statement == 'SELECT document_id FROM document' \
+				' WHERE (document_id > %s) AND (storage_type = %s)', qb.statement
+	assert qb.parameters == (5, 'email')
+
+def test_fork_leaves_parent_untouched():
+	base = QueryBuilder() \
+		.relation('document d') \
+		.join('email_documents.email em', using='document_id') \
+		.project('d.document_id') \
+		.where('d.legal_case_id = %s', 12)
+
+	base_statement = base.statement
+
+	emails = base.fork() \
+		.where('em.sender = %s', 'joe') \
+		.left_join('document_comment dc', using='document_id') \
+		.project('dc.comment') \
+		.limit(10)
+
+	assert base.statement == base_statement
+	assert base.parameters == (12,)
+
+	assert emails.statement == 'SELECT d.document_id, dc.comment FROM document d' \
+			' INNER JOIN email_documents.email em USING (document_id)' \
+			' LEFT JOIN document_comment dc USING (document_id)' \
+			' WHERE (d.legal_case_id = %s) AND (em.sender = %s) LIMIT %s', emails.statement
+	assert emails.parameters == (12, 'joe', 10)
+
+def test_fork_parent_mutation_not_seen_by_child():
+	base = QueryBuilder().relation('document d').project('d.document_id') \
+				.where('d.legal_case_id = %s', 12)
+
+	child = base.fork()
+
+	base.where('d.storage_type = %s', 'email') \
+		.join('foo f', using='document_id')
+
+	assert child.statement == 'SELECT d.document_id FROM document d WHERE d.legal_case_id = %s'
+	assert child.parameters == (12,)
+
+	# Aliases are tracked independently as well.
+	child.join('bar f', using='document_id')
+
+def test_sibling_forks_independent():
+	base = QueryBuilder().relation('document d').project('d.document_id')
+
+	a = base.fork().where('a = %s', 1).where('b = %s', 2)
+	b = base.fork().where(OR(('c = %s', 3), ('d = %s', 4)))
+
+	assert a.statement == 'SELECT d.document_id FROM document d WHERE (a = %s) AND (b = %s)'
+	assert a.parameters == (1, 2)
+	assert b.statement == 'SELECT d.document_id FROM document d WHERE (c = %s) OR (d = %s)'
+	assert b.parameters == (3, 4)
+
+def test_incremental_where_matches_full_expansion():
+	clauses = [('a = %s', 1), 'b is null', OR(('c = %s', 3), ('d = %s', 4)), ('e in %s', (5, 6))]
+
+	incremental = AND()
+	for clause in clauses:
+		# Render between appends, so each append folds into a prior expansion.
+		incremental.expression
+		incremental.append(clause)
+
+	assert incremental.expression == AND(*clauses).expression
+	assert incremental.parameters == AND(*clauses).parameters
+
+def test_normalize_in_lists():
+	statement, params = normalize_in_lists(
+			'a in %s and b not in %s and c = %s and join_in %s and d in %s and e like %s%%',
+			((1, 2), [3], (4, 5), ('x',), (), 'f'))
+
+	assert statement == 'a = any(%s) and b <> all(%s) and c = %s' \
+			' and join_in %s and d = any(%s) and e like %s%%', statement
+	assert params == ([1, 2], [3], (4, 5), ('x',), [], 'f'), params
+
+def test_builder_normalize_in_lists_opt_in():
+	def build(**kwargs):
+		return QueryBuilder(**kwargs) \
+			.relation('document d') \
+			.join('bar b', on='b.id = d.id and b.kind IN %s', params=(('a', 'b'),)) \
+			.project('d.document_id') \
+			.where('d.document_id in %s', (tuple(range(5)),)) \
+			.where('d.storage_type = %s', 'email')
+
+	plain = build()
+	assert 'd.document_id in %s' in plain.statement
+	assert plain.parameters == (('a', 'b'), (0, 1, 2, 3, 4), 'email')
+
+	normalized = build(normalize_in_lists=True)
+	assert normalized.statement == 'SELECT d.document_id FROM document d' \
+			' INNER JOIN bar b ON (b.id = d.id and b.kind = any(%s))' \
+			' WHERE (d.document_id = any(%s)) AND (d.storage_type = %s)', normalized.statement
+	assert normalized.parameters == (['a', 'b'], [0, 1, 2, 3, 4], 'email')
+
+def test_keyset_after_single_direction():
+	qb = QueryBuilder() \
+		.relation('document d') \
+		.project('d.document_id') \
+		.join('foo f', on='f.id = d.id and f.kind = %s', params=('x',)) \
+		.where('d.storage_type = %s', 'email') \
+		.order_by('d.created', 'd.document_id') \
+		.after(('2020-01-01', 42)) \
+		.limit(10)
+
+	assert qb.statement == 'SELECT d.document_id FROM document d' \
+			' INNER JOIN foo f ON (f.id = d.id and f.kind = %s)' \
+			' WHERE (d.storage_type = %s) AND ((d.created, d.document_id) > (%s, %s))' \
+			' ORDER BY d.created, d.document_id LIMIT %s', qb.statement
+	# joins, then wheres, then the keyset, then limit.
+	assert qb.parameters == ('x', 'email', '2020-01-01', 42, 10), qb.parameters
+
+def test_keyset_after_mixed_directions():
+	qb = QueryBuilder() \
+		.relation('document d') \
+		.project('d.document_id') \
+		.order_by('d.created DESC', 'd.document_id') \
+		.after(('2020-01-01', 42))
+
+	assert qb.statement == 'SELECT d.document_id FROM document d' \
+			' WHERE d.created <= %s AND ((d.created < %s)' \
+			' OR (d.created = %s AND d.document_id > %s))' \
+			' ORDER BY d.created DESC, d.document_id', qb.statement
+	assert qb.parameters == ('2020-01-01', '2020-01-01', '2020-01-01', 42), qb.parameters
+
+def test_keyset_after_grouped_goes_to_having():
+	qb = QueryBuilder() \
+		.relation('document') \
+		.project('storage_type', 'count(*)') \
+		.where('document_id > %s', 999) \
+		.group_by('storage_type') \
+		.having('count(*) > %s', 123) \
+		.order_by('storage_type desc') \
+		.after(('email',))
+
+	assert qb.statement == 'SELECT storage_type, count(*) FROM document' \
+			' WHERE document_id > %s GROUP BY storage_type' \
+			' HAVING (count(*) > %s) AND (storage_type < %s)' \
+			' ORDER BY storage_type desc', qb.statement
+	assert qb.parameters == (999, 123, 'email'), qb.parameters
+
+def test_keyset_after_nulls_ordering():
+	qb = QueryBuilder() \
+		.relation('document d') \
+		.project('d.document_id') \
+		.order_by('d.created desc nulls last', 'd.document_id NULLS FIRST') \
+		.after(('2020-01-01', 42))
+
+	assert qb.statement == 'SELECT d.document_id FROM document d' \
+			' WHERE d.created <= %s AND ((d.created < %s)' \
+			' OR (d.created = %s AND d.document_id > %s))' \
+			' ORDER BY d.created desc nulls last, d.document_id NULLS FIRST', qb.statement
+
+	import collections
+	Row = collections.namedtuple('Row', ('document_id', 'created'))
+	assert decode_page_token(qb.page_token(Row(42, '2020-01-01'))) == ('2020-01-01', 42)
+
+def test_keyset_page_token():
+	import collections
+	import datetime
+
+	qb = QueryBuilder() \
+		.relation('document d') \
+		.project('d.document_id', 'd.created') \
+		.order_by('d.created desc', 'd.document_id')
+
+	Row = collections.namedtuple('Row', ('document_id', 'created'))
+	token = qb.page_token(Row(42, datetime.datetime(2020, 1, 1, 12, 30)))
+
+	assert decode_page_token(token) == ('2020-01-01 12:30:00', 42)
+
+	# Token or values, same thing.
+	assert qb.fork().after(token).parameters == \
+			qb.fork().after(('2020-01-01 12:30:00', 42)).parameters
+
+	# Starting over.
+	assert 'WHERE' not in qb.after(None).statement
+
+	# Keyset values must match the ordering.
+	qb.after((1,))
+	try:
+		qb.statement
+		assert False, 'Expected ValueError'
+	except ValueError:
+		pass
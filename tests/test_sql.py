@@ -0,0 +1,618 @@
+import datetime
+import decimal
+import json
+import os
+import sys
+import time
+import uuid
+
+import psycopg2
+import psycopg2.errors
+import pytest
+
+from jlr import sql
+from jlr.sql import ColumnData, RowClassCache
+
+
+# Tests against a live database need a scratch postgres, as in
+#   JLR_TEST_DSN='postgresql://postgres@/postgres?host=/tmp' pytest
+DSN = os.environ.get('JLR_TEST_DSN')
+
+needs_db = pytest.mark.skipif(not DSN, reason='JLR_TEST_DSN not set')
+
+
+@pytest.fixture
+def con():
+    # Everything done within is rolled back afterwards.
+    con = sql.connection(DSN)
+    yield con
+    con.rollback()
+    con.close()
+
+def make_table(con, name, columns):
+    sql.execute(con, 'create temporary table %s (%s)' % (name, columns))
+
+
+def test_row_class_cache_namedtuple():
+    cache = RowClassCache(capacity=4)
+
+    make = cache.get('namedtuple', ('id', 'first name', '1st'))
+    row = make((1, 'Joe', True))
+
+    assert row == (1, 'Joe', True)
+    assert row.id == 1 and row.first_name == 'Joe' and row.f1st is True
+
+    # Same shape, same class.
+    assert cache.get('namedtuple', ('id', 'first name', '1st')) is make
+
+def test_row_class_cache_slots():
+    cache = RowClassCache()
+
+    make = cache.get('slots', ('id', 'name'))
+    row = make((1, 'Joe'))
+
+    assert not hasattr(row, '__dict__')
+    assert row.id == 1 and row.name == 'Joe'
+    assert row[0] == 1 and row[-1] == 'Joe' and row[:1] == (1,)
+    assert len(row) == 2
+    assert row == (1, 'Joe')
+    assert row._asdict() == {'id': 1, 'name': 'Joe'}
+
+    id, name = row
+    assert (id, name) == (1, 'Joe')
+
+def test_row_class_cache_slots_duplicate_names():
+    with pytest.raises(ValueError):
+        RowClassCache().get('slots', ('id', 'id'))
+
+def test_row_class_cache_bounded():
+    cache = RowClassCache(capacity=2)
+
+    for names in (('a',), ('b',), ('c',)):
+        cache.get('namedtuple', names)
+
+    assert len(cache) == 2
+
+    cache.clear()
+    assert len(cache) == 0
+
+def test_column_data_typed_with_nulls():
+    column = ColumnData('score', 701)   # float8
+
+    column.extend((1.5, 2.5))
+    assert column.nulls is None
+
+    column.extend((None, 4.0))
+    column.extend((5.0,))
+
+    assert column.values.typecode == 'd'
+    assert list(column.values) == [1.5, 2.5, 0.0, 4.0, 5.0]
+    assert list(column.nulls) == [0, 0, 1, 0, 0]
+    assert len(column) == 5
+
+def test_column_data_untyped():
+    column = ColumnData('name', 25)     # text
+
+    column.extend(('a', None))
+
+    assert column.values == ['a', None]
+    assert column.nulls is None
+
+
+@needs_db
+def test_insert_many_keeps_char_and_bit_lengths(con):
+    make_table(con, 'fixed', 'id int, code char(5), flags bit(3)')
+
+    sql.insert_many(con, 'fixed', [{'id': 1, 'code': 'ABCDE', 'flags': '101'},
+                                   {'id': 2, 'code': 'XY', 'flags': '011'}])
+
+    assert sql.query(con, 'select code, flags from fixed order by id',
+                     row_mode='tuple') == [('ABCDE', '101'), ('XY   ', '011')]
+
+@needs_db
+@pytest.mark.parametrize('method', ['values', 'unnest'])
+def test_bulk_update_keeps_char_and_bit_lengths(con, method):
+    make_table(con, 'fixed', 'id int, code char(5), flags bit(3)')
+    sql.bulk_insert(con, 'fixed', [{'id': 1, 'code': 'A', 'flags': '000'},
+                                   {'id': 2, 'code': 'B', 'flags': '000'}])
+
+    assert sql.bulk_update(con, 'fixed', 'id',
+                           [{'id': 1, 'code': 'ZZZZZ', 'flags': '110'},
+                            {'id': 2, 'code': 'QRS', 'flags': '111'}],
+                           method=method) == 2
+
+    assert sql.query(con, 'select code, flags from fixed order by id',
+                     row_mode='tuple') == [('ZZZZZ', '110'), ('QRS  ', '111')]
+
+@needs_db
+def test_prepared_statements_rewrite_placeholders(con):
+    cache = sql.enable_prepared_statements(con, threshold=2)
+
+    for _ in range(3):
+        assert sql.query_single_value(con, "select %s::int + %s || '%%'", (1, 2)) == '3%'
+        assert sql.query_single_value(
+                    con, 'select %(a)s * 10 + %(b)s + %(a)s',
+                    {'a': 1, 'b': 2}) == 13
+
+    assert "select %s::int + %s || '%%'" in cache
+    assert 'select %(a)s * 10 + %(b)s + %(a)s' in cache
+
+    # Without params, the text is left alone, '%%' and all.
+    for _ in range(3):
+        assert sql.query_single_value(con, "select 'abc%%'") == 'abc%%'
+    assert "select 'abc%%'" in cache
+
+@needs_db
+def test_prepared_statements_keep_psycopg2_typing(con):
+    cache = sql.enable_prepared_statements(con, threshold=1)
+
+    # The server types a bare parameter as text ...
+    for value in (5, 'five', 5.5, None, 6):
+        assert sql.query_single_value(con, 'select %s', (value,)) == value
+    assert 'select %s' in cache
+
+    # ... and would round a float bound to an integer one.
+    sql.query_single_value(con, 'select %s + 1', (1,))
+    assert sql.query_single_value(con, 'select %s + 1', (1.5,)) == 2.5
+
+@needs_db
+def test_prepared_statements_out_of_range_ints(con):
+    make_table(con, 'ranged', 'id int, small smallint, big bigint')
+    sql.execute(con, 'insert into ranged values (1, 1, 1)')
+    cache = sql.enable_prepared_statements(con, threshold=1)
+
+    for column, value in (('id', 2 ** 31), ('id', -2 ** 31 - 1),
+                          ('small', 2 ** 15), ('big', 2 ** 63)):
+        stmt = 'select id from ranged where %s = %%s' % (column,)
+        assert sql.query(con, stmt, (1,)) == [(1,)]
+        assert stmt in cache
+
+        # Compared as numeric, as unprepared, rather than overflowing.
+        assert sql.query(con, stmt, (value,)) == []
+
+    # Transaction still fine.
+    assert sql.query_single_value(con, 'select 1') == 1
+
+@needs_db
+def test_prepared_statements_unpreparable_fall_back(con):
+    cache = sql.enable_prepared_statements(con, threshold=1)
+
+    stmt = 'select 1 where (%s is null or 1 = %s)'
+    for _ in range(3):
+        assert sql.query_single_value(con, stmt, (None, None)) == 1
+    assert stmt not in cache
+
+    # The failed PREPARE didn't spoil the transaction.
+    assert sql.query_single_value(con, 'select 2') == 2
+
+    con.rollback()
+    con.autocommit = True
+    stmt = 'select 3 where (%s is null or 3 = %s)'
+    for _ in range(2):
+        assert sql.query_single_value(con, stmt, (3, 3)) == 3
+    assert stmt not in cache
+
+@needs_db
+def test_query_page_after(con):
+    make_table(con, 'paged', 'id int primary key')
+    sql.execute(con, 'insert into paged select generate_series(1, 10)')
+
+    qt = sql.QueryTool(con, row_mode='tuple') \
+                .project('id').relation('paged').order_by('id desc').after((8,))
+
+    page = qt.query_page(3)
+    assert page.rows == [(7,), (6,), (5,)]
+    # Spanning all pages, as with offset.
+    assert page.total == 10 and not page.estimated
+
+    page = qt.query_page(3, estimate_over=0)
+    assert page.rows == [(7,), (6,), (5,)] and page.estimated
+
+@needs_db
+def test_query_page_keeps_order(con):
+    make_table(con, 'paged', 'id int primary key, grp int')
+    sql.execute(con, 'insert into paged select g, g % 3 from generate_series(1, 10) g')
+
+    qt = sql.QueryTool(con, row_mode='tuple') \
+                .project('id', 'grp').relation('paged').order_by('grp desc', 'id')
+
+    page = qt.query_page(4, offset=1)
+    assert page.rows == [(5, 2), (8, 2), (1, 1), (4, 1)] and page.total == 10
+
+    assert qt.fork().query_page(3, offset=20) == sql.Page([], 10, False)
+
+    distinct = sql.QueryTool(con, row_mode='tuple')
+    distinct._kind = 'SELECT DISTINCT'
+    page = distinct.project('grp').relation('paged').order_by('grp').query_page(2)
+    assert page.rows == [(0,), (1,)] and page.total == 3
+
+@needs_db
+def test_query_by_keys_dedupes_across_chunks(con):
+    make_table(con, 'keyed', 'id int primary key')
+    sql.execute(con, 'insert into keyed select generate_series(1, 5)')
+
+    for strategy in ('chunks', 'temp_table'):
+        rows = sql.query_by_keys(con, 'keyed', 'id', [1, 2, 3, 1, 4, 2],
+                                 strategy=strategy, chunk_size=2)
+        assert sorted(r.id for r in rows) == [1, 2, 3, 4], strategy
+
+@needs_db
+def test_query_by_keys_temp_table_dropped_upon_error(con):
+    con.autocommit = True
+    make_table(con, 'keyed', 'id int primary key')
+
+    with pytest.raises(psycopg2.errors.InvalidTextRepresentation):
+        sql.query_by_keys(con, 'keyed', 'id', [1, 2, 'three'],
+                          strategy='temp_table', chunk_size=1)
+
+    assert sql.query_single_value(
+                con, "select count(*) from pg_class"
+                     " where relname like 'jlr_keys_%%'"
+                     " and relnamespace = pg_my_temp_schema()") == 0
+
+@needs_db
+def test_copy_insert_text_round_trip(con):
+    make_table(con, 'copied',
+               'id int, t text, b boolean, n numeric, d date, ts timestamp,'
+               ' iv interval, raw bytea, doc jsonb, tags text[], grid int[]')
+
+    rows = [
+        {'id': 1, 't': 'tab\there\nnewline \\ back\\slash\r', 'b': True,
+         'n': decimal.Decimal('-1.50'), 'd': datetime.date(2020, 2, 29),
+         'ts': datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+         'iv': datetime.timedelta(days=-1, seconds=5, microseconds=7),
+         'raw': b'\x00\xff\\', 'doc': {'a': [1, 'two']},
+         'tags': ['x', 'has "quotes"', 'back\\slash', None, 'comma,brace}'],
+         'grid': [[1, 2], [3, None]]},
+        {'id': 2, 't': '', 'b': False},
+    ]
+
+    assert sql.copy_insert(con, 'copied', rows) == 2
+
+    first, second = sql.query(con, 'select * from copied order by id')
+
+    for k, v in rows[0].items():
+        if k != 'raw':
+            assert getattr(first, k) == v, k
+    assert first.raw.tobytes() == b'\x00\xff\\'
+
+    assert second.t == '' and second.b is False and second.n is None
+    assert second.tags is None
+
+@needs_db
+def test_copy_insert_binary_round_trip(con):
+    make_table(con, 'copied',
+               'id int, small smallint, big bigint, f4 real, f8 float8,'
+               ' n numeric, t text, v varchar(10), c char(3), d date, tm time,'
+               ' ts timestamp, tstz timestamptz, u uuid, j json, jb jsonb,'
+               ' raw bytea, b boolean')
+
+    numerics = ['1E+5', '0.00001', '-1.5', '0', '0.000', '-0.00001',
+                '123456789.123456789', '1E-20', '1E+20', '10000', '-1E+5',
+                '0.0001000', '100000000.00001', 'NaN']
+
+    u = str(uuid.uuid4())
+    tstz = datetime.datetime(2020, 1, 2, 3, 4, 5, 6, tzinfo=datetime.timezone.utc)
+    rows = [{'id': i, 'n': decimal.Decimal(n)} for i, n in enumerate(numerics)]
+    rows[0].update(small=-2, big=2 ** 40, f4=1.5, f8=-2.25, t='text',
+                   v='varchar', c='abc', d=datetime.date(1999, 12, 31),
+                   tm=datetime.time(23, 59, 59, 999999),
+                   ts=datetime.datetime(1970, 1, 1), tstz=tstz, u=u,
+                   j={'a': 1}, jb=[1, None], raw=b'\x00\x01', b=True)
+
+    assert sql.copy_insert(con, 'copied', rows, copy_format='binary') == len(rows)
+
+    # Numerics spelled the same as when sent as text.
+    assert sql.query(con, 'select n::text from copied order by id',
+                     row_mode='tuple') == \
+        sql.query(con, 'select n::numeric::text from unnest(%s::text[])'
+                       ' with ordinality u(n, o) order by o', (numerics,),
+                  row_mode='tuple')
+
+    first = sql.query_single_row(con, 'select * from copied where id = 0')
+    expected = dict(rows[0], raw=None, n=decimal.Decimal('1E+5'))
+    for k, v in expected.items():
+        if k != 'raw':
+            assert getattr(first, k) == v, k
+    assert first.raw.tobytes() == b'\x00\x01'
+
+@needs_db
+def test_copy_insert_binary_refusals(con):
+    make_table(con, 'copied', 'tstz timestamptz, p point')
+
+    # Raised mid-COPY, so arrives wrapped by psycopg2.
+    with pytest.raises(psycopg2.errors.QueryCanceled, match='Naive datetime'):
+        sql.copy_insert(con, 'copied', [{'tstz': datetime.datetime(2020, 1, 1)}],
+                        copy_format='binary')
+    con.rollback()
+    make_table(con, 'copied', 'tstz timestamptz, p point')
+    with pytest.raises(ValueError, match='No binary COPY encoder'):
+        sql.copy_insert(con, 'copied', [{'p': '(1,2)'}], copy_format='binary')
+
+@needs_db
+@pytest.mark.parametrize('staging_threshold', [10000, 2])
+def test_bulk_upsert(con, staging_threshold):
+    # The default threshold sends multi-row upserts; 2 stages via COPY.
+    make_table(con, 'upserted', 'id int primary key, name text, tenant int')
+    sql.bulk_insert(con, 'upserted', [{'id': 1, 'name': 'one', 'tenant': 0}])
+
+    counts = sql.bulk_upsert(con, 'upserted',
+                             iter([{'id': 1, 'name': 'uno'},
+                                   {'id': 2, 'name': 'two'},
+                                   {'id': 3, 'name': 'three'},
+                                   {'id': 2, 'name': 'dos'}]),
+                             'id', addToEveryRow={'tenant': 7},
+                             batch_size=2, staging_threshold=staging_threshold)
+
+    # Repeated conflict keys collapse, last one wins.
+    assert counts == sql.UpsertCounts(inserted=2, updated=1)
+    assert sql.query(con, 'select id, name, tenant from upserted order by id',
+                     row_mode='tuple') == [(1, 'uno', 7), (2, 'dos', 7),
+                                           (3, 'three', 7)]
+
+    # Do nothing upon conflict.
+    counts = sql.bulk_upsert(con, 'upserted',
+                             [{'id': 3, 'name': 'tres'}, {'id': 4, 'name': 'four'},
+                              {'id': 5, 'name': 'five'}],
+                             'id', update_columns=[],
+                             staging_threshold=staging_threshold)
+    assert counts == sql.UpsertCounts(inserted=2, updated=0)
+    assert sql.query_single_value(con, 'select name from upserted where id = 3') == 'three'
+
+    assert sql.bulk_upsert(con, 'upserted', [], 'id') == sql.UpsertCounts(0, 0)
+
+    # Staging tables don't outlive the call.
+    assert sql.query_single_value(
+                con, "select count(*) from pg_class"
+                     " where relname like 'jlr_upsert_staging_%%'"
+                     " and relnamespace = pg_my_temp_schema()") == 0
+
+    with pytest.raises(ValueError):
+        sql.bulk_upsert(con, 'upserted', [{'name': 'x'}], 'id')
+
+@needs_db
+def test_query_page_orders_by_aliases_and_ordinals(con):
+    make_table(con, 'paged', 'id int primary key, grp int')
+    sql.execute(con, 'insert into paged select g, g % 3 from generate_series(1, 25) g')
+
+    grouped = sql.QueryTool(con, row_mode='tuple') \
+                .project('grp', 'count(*) as n').relation('paged').group_by('grp')
+
+    for order in (('n desc', 'grp'), ('2 desc', '1'), ('count(*) desc', 'grp')):
+        qt = grouped.fork().order_by(*order)
+        page = qt.query_page(2)
+        assert page.rows == qt.query()[:2] == [(1, 9), (0, 8)], order
+        assert page.total == 3
+
+    for order in ('1', 'n desc'):
+        qt = grouped.fork().order_by(order)
+        assert qt.query_page(3).rows == qt.query(), order
+
+    qt = sql.QueryTool(con, row_mode='tuple') \
+                .project('id, grp g').relation('paged').where('id < %s', 10) \
+                .order_by('g', '1 desc')
+    assert qt.query_page(4).rows == qt.query()[:4]
+
+    # An ordinal into '*' can't be respelled, so counts separately.
+    qt = sql.QueryTool(con, row_mode='tuple') \
+                .project('*').relation('paged').order_by('2', '1 desc')
+    page = qt.query_page(3, offset=1)
+    assert page.rows == qt.query()[1:4] and page.total == 25
+
+@needs_db
+@pytest.mark.parametrize('row_mode', sql.ROW_MODES)
+def test_iter_pages_each_row_mode(con, row_mode):
+    make_table(con, 'paged', 'id int primary key, grp int')
+    sql.execute(con, 'insert into paged select g, g % 3 from generate_series(1, 7) g')
+
+    qt = sql.QueryTool(con, row_mode=row_mode) \
+                .project('p.grp', 'p.id').relation('paged p').order_by('p.grp', 'p.id desc')
+
+    pages = list(qt.iter_pages(page_size=3))
+
+    assert [len(p) for p in pages] == [3, 3, 1]
+    assert [tuple(r) for p in pages for r in p] == \
+                [tuple(r) for r in qt.query()]
+
+@needs_db
+def test_introspect_table_matches_information_schema(con):
+    sql.execute(con, 'create domain jlr_pos as int check (value > 0)')
+    sql.execute(con, 'create domain jlr_tags as text[]')
+    sql.execute(con, 'create type jlr_pair as (a int, b text)')
+    sql.execute(con, "create type jlr_mood as enum ('ok')")
+    make_table(con, 'typed',
+               'i int, c char(5), v varchar(3), n numeric(5, 2), f float8,'
+               ' ts timestamptz, tm time(3), iv interval, b bit(3), vb varbit,'
+               ' ch "char", t text[], ii int[][], p jlr_pos, tags jlr_tags,'
+               ' pair jlr_pair, mood jlr_mood, j jsonb, u uuid')
+
+    expected = sql.query(con, """
+        select column_name, data_type from information_schema.columns
+        where table_name = 'typed' order by ordinal_position""",
+                         row_mode='tuple')
+
+    columns = sql.introspect_table(con, 'typed')
+    assert [(c.name, c.data_type) for c in columns] == expected
+
+    by_name = dict((c.name, c) for c in columns)
+    assert by_name['c'].type_name == 'character(5)'
+    assert by_name['ii'].type_name == 'integer[]'
+
+@needs_db
+def test_introspect_table_keys_and_indexes(con):
+    make_table(con, 'keyed', 'a int, b int, c text, primary key (b, a)')
+    sql.execute(con, 'create unique index keyed_c on keyed (c)')
+    sql.execute(con, 'create index keyed_lower_c on keyed (lower(c), a)')
+
+    table = sql.metadata_cache.table(con, sql.query_single_value(
+                    con, 'select nspname from pg_namespace'
+                         ' where oid = pg_my_temp_schema()'), 'keyed')
+
+    assert table.primary_key == ['b', 'a']
+    assert [(c.name, c.primary_key, c.not_null) for c in table.columns] == \
+                [('a', True, True), ('b', True, True), ('c', False, False)]
+
+    indexes = dict((i.name, i) for i in table.indexes)
+    assert sorted(indexes) == ['keyed_c', 'keyed_lower_c', 'keyed_pkey']
+    assert indexes['keyed_pkey'].primary and indexes['keyed_pkey'].unique
+    assert indexes['keyed_pkey'].columns == ['b', 'a']
+    assert indexes['keyed_c'].unique and not indexes['keyed_c'].primary
+    # Expression members have no column name.
+    assert indexes['keyed_lower_c'].columns == [None, 'a']
+    assert 'lower(c)' in indexes['keyed_lower_c'].definition
+
+@needs_db
+def test_metadata_cache_expiry_and_invalidation(con):
+    cache = sql.SchemaMetadataCache(ttl_secs=60)
+
+    sql.execute(con, 'create table public.jlr_cached_a (id int)')
+    assert ('public', 'jlr_cached_a') in cache.tables(con)
+
+    # Cached: tables created since aren't seen ...
+    sql.execute(con, 'create table public.jlr_cached_b (id int)')
+    assert ('public', 'jlr_cached_b') not in cache.tables(con)
+    # ... though direct lookups fall back to a one-off query.
+    assert cache.table(con, 'public', 'jlr_cached_b').name == 'jlr_cached_b'
+
+    cache.invalidate(con)
+    assert ('public', 'jlr_cached_b') in cache.tables(con)
+
+    sql.execute(con, 'create table public.jlr_cached_c (id int)')
+    cache.invalidate()
+    assert ('public', 'jlr_cached_c') in cache.tables(con)
+
+    sql.execute(con, 'create table public.jlr_cached_d (id int)')
+    assert ('public', 'jlr_cached_d') not in cache.tables(con)
+    cache.ttl_secs = 0
+    time.sleep(0.01)
+    assert ('public', 'jlr_cached_d') in cache.tables(con)
+
+@needs_db
+def test_introspection_returns_copies(con):
+    sql.execute(con, 'create table public.jlr_copied (id int primary key)')
+    sql.metadata_cache.invalidate(con)
+
+    columns = sql.introspect_table(con, 'public.jlr_copied')
+    columns[0].data_type = 'text'
+    columns.append('junk')
+
+    table = sql.introspect_schema(con, 'public')['jlr_copied']
+    table.primary_key.append('junk')
+    table.columns[0].name = 'junk'
+    table.indexes[0].columns.append('junk')
+
+    assert [(c.name, c.data_type) for c in
+            sql.introspect_table(con, 'public.jlr_copied')] == [('id', 'integer')]
+    table = sql.introspect_schema(con, 'public')['jlr_copied']
+    assert table.primary_key == ['id'] and table.indexes[0].columns == ['id']
+
+@needs_db
+@pytest.mark.parametrize('row_mode', sql.ROW_MODES)
+def test_named_row_cursor_iterates_past_itersize(con, row_mode):
+    # More rows than both itersize and the recursion limit; iteration
+    # used to recurse once per row.
+    n = sys.getrecursionlimit() + 500
+
+    cur = sql._cursor(con, row_mode, name='jlr_test_named_%s' % row_mode)
+    cur.itersize = 100
+    cur.execute('select g as id, -g as neg from generate_series(1, %s) g',
+                (n,))
+
+    rows = list(cur)
+    cur.close()
+
+    assert len(rows) == n
+    assert [tuple(r) for r in rows[:2]] == [(1, -1), (2, -2)]
+    if row_mode == 'tuple':
+        assert type(rows[-1]) is tuple
+    else:
+        assert (rows[-1].id, rows[-1].neg) == (n, -n)
+
+@needs_db
+def test_query_iter_rows_and_batches(con):
+    stmt = 'select g as id from generate_series(1, %s) g'
+
+    rows = list(sql.query_iter(con, stmt, (25,), itersize=10))
+    assert [r.id for r in rows] == list(range(1, 26))
+
+    batches = list(sql.query_iter(con, stmt, (25,), itersize=10,
+                                  batches=True))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert [r.id for b in batches for r in b] == list(range(1, 26))
+
+    assert list(sql.query_iter(con, stmt, (0,), batches=True)) == []
+
+@needs_db
+@pytest.mark.parametrize('row_mode', sql.ROW_MODES)
+def test_query_iter_row_mode(con, row_mode):
+    rows = list(sql.query_iter(con, 'select 1 as a, 2 as b union all'
+                                    ' select 3, 4', row_mode=row_mode))
+
+    assert [tuple(r) for r in rows] == [(1, 2), (3, 4)]
+    if row_mode == 'tuple':
+        assert type(rows[0]) is tuple
+    else:
+        assert (rows[1].a, rows[1].b) == (3, 4)
+
+@needs_db
+def test_query_iter_closed_after_transaction_ended(con):
+    rows = sql.query_iter(con, 'select generate_series(1, 10)', itersize=2)
+    assert next(rows) == (1,)
+
+    # Commit takes the server-side cursor with it; closing the
+    # generator afterwards mustn't complain.
+    con.commit()
+    rows.close()
+
+@needs_db
+@pytest.mark.parametrize('n', [0, 3, 10, 25])
+def test_json_iter_matches_query_json_strings(con, n):
+    # Empty, a single (partial or exactly full) batch, and several.
+    stmt = 'select g as id, repeat(%%s, g) as s from generate_series(1, %s) g' % n
+
+    expected = sql.query_as_json(con, stmt, ('x',))
+    assert ''.join(sql.query_as_json_iter(con, stmt, ('x',),
+                                          itersize=10)) == expected
+
+    json_stmt = 'select to_json(t.*)::text from (%s) t' % stmt
+    expected = sql.query_json_strings(con, json_stmt, ('x',))
+    assert ''.join(sql.query_json_strings_iter(con, json_stmt, ('x',),
+                                               itersize=10)) == expected
+
+    assert json.loads(expected) == [{'id': i, 's': 'x' * i}
+                                    for i in range(1, n + 1)]
+
+@needs_db
+def test_query_as_json_agg(con):
+    assert sql.query_as_json(con, 'select 1 as a where false',
+                             strategy='agg') == '[]'
+
+    stmt = "select g as a, 'b' || g as b from generate_series(1, 3) g"
+    assert json.loads(sql.query_as_json(con, stmt, strategy='agg')) == \
+                json.loads(sql.query_as_json(con, stmt))
+
+def test_json_strategy_for_plan(monkeypatch):
+    monkeypatch.setattr(sql, 'json_agg_max_estimated_bytes', 1000)
+
+    assert sql._json_strategy_for_plan({'Plan Rows': 10,
+                                        'Plan Width': 100}) == 'agg'
+    assert sql._json_strategy_for_plan({'Plan Rows': 11,
+                                        'Plan Width': 100}) == 'rows'
+
+@needs_db
+def test_query_as_json_auto(con, monkeypatch):
+    stmt = 'select g as a from generate_series(1, 2) g'
+
+    # The strategies' array spellings differ just enough to tell apart.
+    agg = sql.query_as_json(con, stmt, strategy='agg')
+    rows = sql.query_as_json(con, stmt, strategy='rows')
+    assert agg != rows
+
+    assert sql.query_as_json(con, stmt, strategy='auto') == agg
+
+    monkeypatch.setattr(sql, 'json_agg_max_estimated_bytes', 1)
+    assert sql.query_as_json(con, stmt, strategy='auto') == rows
+
+def test_query_as_json_unknown_strategy():
+    with pytest.raises(ValueError, match='Unknown query_as_json strategy'):
+        sql.query_as_json(None, 'select 1', strategy='bogus')